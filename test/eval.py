@@ -24,6 +24,8 @@ from transformers.image_utils import to_numpy_array
 import habitat
 from habitat import logger, Env
 from habitat_extensions import measures
+from habitat_extensions.maps import TOP_DOWN_MAP_CACHE_DIR, get_top_down_map
+from habitat_extensions.trajectory import TrajectoryRecorder
 from habitat.config.default import get_agent_config
 from habitat_baselines.config.default import get_config as get_habitat_config
 from habitat.config.default_structured_configs import (
@@ -84,15 +86,23 @@ class VLNEvaluator:
         self.agent_config = get_agent_config(self.config.habitat.simulator)
         self.sim_sensors_config = self.config.habitat.simulator.agents.main_agent.sim_sensors
         self.save_video_ratio = args.save_video_ratio
+        self.save_trajectory = args.save_trajectory
+        self.map_resolution = 1024
+        # render_trajectories reads the floor maps from here, so trajectories
+        # are only renderable if the maps are written to disk
+        self.top_down_map_cache_dir = args.top_down_map_cache_dir
+        if self.save_trajectory and self.top_down_map_cache_dir is None:
+            self.top_down_map_cache_dir = os.path.join(self.output_path, "top_down_maps")
 
 
         with habitat.config.read_write(self.config):
             self.config.habitat.dataset.split = self.split
+            measures.add_agent_state_measure(self.config)
             self.config.habitat.task.measurements.update(
                 {
                     "top_down_map": TopDownMapMeasurementConfig(
                         map_padding=3,
-                        map_resolution=1024,
+                        map_resolution=self.map_resolution,
                         draw_source=True,
                         draw_border=True,
                         draw_shortest_path=True,
@@ -128,6 +138,15 @@ class VLNEvaluator:
         return env
 
 
+    def record_pose(self, recorder, env, info) -> None:
+        collisions = info.get("collisions")
+        recorder.add_pose(
+            info["agent_state"]["position"],
+            float(info["top_down_map"]["agent_angle"]),
+            info["distance_to_goal"],
+            bool(collisions["is_collision"]) if collisions else False,
+        )
+
     def eval_action(self, idx) -> None:
         env = self.config_env()
         scene_episode_dict = {}
@@ -149,6 +168,10 @@ class VLNEvaluator:
                         spls.append(res['spl'])
                         oss.append(res['os'])
                         ones.append(res['ne'])
+
+        recorder = None
+        if self.save_trajectory:
+            recorder = TrajectoryRecorder(os.path.join(self.output_path, 'trajectories'), rank=idx)
         
         for scene in sorted(scene_episode_dict.keys()):
             episodes = scene_episode_dict[scene]
@@ -165,6 +188,14 @@ class VLNEvaluator:
 
                 env.current_episode = episode
                 observations = env.reset()
+                if recorder is not None:
+                    recorder.start_episode(scene_id, episode_id, getattr(episode, "reference_path", None), episode.goals[0].position)
+                    # cache the floor map so trajectories can be rendered offline
+                    get_top_down_map(
+                        env.sim, self.map_resolution,
+                        maps.calculate_meters_per_pixel(self.map_resolution, sim=env.sim),
+                        cache_dir=self.top_down_map_cache_dir,
+                    )
 
                 vis_frames = []
                 step_id = 0
@@ -188,6 +219,8 @@ class VLNEvaluator:
                     rgb_list.append(image)
                     
                     info = env.get_metrics()
+                    if recorder is not None:
+                        self.record_pose(recorder, env, info)
                         
                     history_len = len(rgb_list) - 1 
                     
@@ -214,11 +247,17 @@ class VLNEvaluator:
                     if step_id >= self.args.max_steps:
                         action = 0
 
+                    action_seq.append(action)
+                    if recorder is not None:
+                        recorder.add_action(action)
                     observations = env.step(action)
                     step_id += 1
 
                 process_bar.update(1)
                 metrics = env.get_metrics()
+                if recorder is not None:
+                    self.record_pose(recorder, env, metrics)
+                    recorder.end_episode()
                 if should_save_video:
                     images_to_video(
                         vis_frames, os.path.join(self.output_path, f'vis_{self.epoch}'), f'{scene_id}_{episode_id}', fps=6, quality=9
@@ -237,12 +276,16 @@ class VLNEvaluator:
                     "os": metrics['oracle_success'],
                     "ne": metrics["distance_to_goal"],
                     "steps": step_id,
-                    "episode_instruction": episode_instruction
+                    "episode_instruction": episode_instruction,
+                    # executed actions, for replay.py
+                    "actions": action_seq,
                 }
                 
                 with open(os.path.join(self.output_path, f'result.json'), 'a') as f:
                     f.write(json.dumps(result) + "\n")
 
+        if recorder is not None:
+            recorder.close()
         env.close()
         return torch.tensor(sucs).to(self.device), torch.tensor(spls).to(self.device), torch.tensor(oss).to(self.device), torch.tensor(ones).to(self.device), torch.tensor(len(sucs)).to(self.device)     
 
@@ -381,6 +424,11 @@ def eval():
     parser.add_argument("--model_max_length", type=int, default=4096,
                         help= "Maximum sequence length. Sequences will be right padded (and possibly truncated).")
     parser.add_argument("--save_video_ratio", type=float, default=0.05, help="0~1")
+    parser.add_argument("--save_trajectory", action="store_true", default=False,
+                        help="record per-episode trajectories for habitat_extensions.batch_metrics")
+    parser.add_argument("--top_down_map_cache_dir", type=str, default=TOP_DOWN_MAP_CACHE_DIR,
+                        help="where floor maps are stored for habitat_extensions.render_trajectories "
+                             "(--cache_dir there); defaults to <output_path>/top_down_maps with --save_trajectory")
     
     parser.add_argument('--world_size', default=1, type=int,
                         help='number of distributed processes')
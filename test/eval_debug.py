@@ -1,6 +1,5 @@
 import sys
 import os
-import gzip
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 import re
 import tqdm
@@ -25,6 +24,7 @@ from transformers.image_utils import to_numpy_array
 import habitat
 from habitat import logger, Env
 from habitat_extensions import measures
+from habitat_extensions.gt_store import load_gt_store
 from habitat.config.default import get_agent_config
 from habitat_baselines.config.default import get_config as get_habitat_config
 from habitat.config.default_structured_configs import (
@@ -89,6 +89,7 @@ class VLNEvaluator:
 
         with habitat.config.read_write(self.config):
             self.config.habitat.dataset.split = self.split
+            measures.add_agent_state_measure(self.config)
             self.config.habitat.task.measurements.update(
                 {
                     "top_down_map": TopDownMapMeasurementConfig(
@@ -132,8 +133,7 @@ class VLNEvaluator:
         gt_path = f"{base}_gt{ext}"
         
         print(f"Loading GT data from {gt_path}")
-        with gzip.open(gt_path, 'rt') as f:
-            self.gt_data = json.load(f)
+        self.gt_data = load_gt_store(gt_path)
 
         self.num_history = args.num_history
 
@@ -179,7 +179,7 @@ class VLNEvaluator:
                     continue
                 
                 if str(episode_id) in self.gt_data:
-                    ref_actions = self.gt_data[str(episode_id)]['actions']
+                    ref_actions = self.gt_data.actions(episode_id).tolist()
                 else:
                     ref_actions = []
 
@@ -0,0 +1,256 @@
+import argparse
+import json
+from typing import Dict, Optional
+
+import numpy as np
+from numpy import ndarray
+
+from habitat_extensions.gt_store import DEFAULT_GT_PATH, GTStore, load_gt_store
+from habitat_extensions.trajectory import load_trajectories
+
+STOP = 0
+
+
+def _segment_ends(offsets: ndarray):
+    return offsets[:-1], offsets[1:]
+
+
+def _pad_segments(values: ndarray, starts: ndarray, lengths: ndarray):
+    """(N, D) ragged rows -> (E, max(lengths), D) zero-padded array."""
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    padded = np.zeros((len(starts), width) + values.shape[1:], values.dtype)
+    mask = np.arange(width)[None, :] < lengths[:, None]
+    rows = (starts[:, None] + np.arange(width)[None, :])[mask]
+    padded[mask] = values[rows]
+    return padded, mask
+
+
+def _path_lengths(positions: ndarray, offsets: ndarray) -> ndarray:
+    starts, ends = _segment_ends(offsets)
+    steps = np.zeros(len(positions), dtype=np.float64)
+    steps[1:] = np.linalg.norm(np.diff(positions, axis=0), axis=1)
+    steps[starts[starts < len(steps)]] = 0.0
+    csum = np.concatenate([[0.0], np.cumsum(steps)])
+    return csum[ends] - csum[starts]
+
+
+def _dedup_consecutive(positions: ndarray, offsets: ndarray):
+    """Drops repeated consecutive positions (turning in place), matching how
+    the online NDTW measure builds its path.
+    """
+    keep = np.ones(len(positions), dtype=bool)
+    keep[1:] = np.any(positions[1:] != positions[:-1], axis=1)
+    keep[offsets[:-1][offsets[:-1] < len(keep)]] = True
+    kept_before = np.concatenate([[0], np.cumsum(keep)])
+    return positions[keep], kept_before[offsets]
+
+
+def batch_dtw(
+    queries: ndarray,
+    query_lengths: ndarray,
+    references: ndarray,
+    reference_lengths: ndarray,
+) -> ndarray:
+    """Exact DTW for a batch of padded (E, T, 3) queries against padded
+    (E, M, 3) references. Rows of the DP table are advanced for every
+    episode at once; each row uses the prefix-min identity of
+    `measures.IncrementalDTW`.
+    """
+    n = len(queries)
+    row = None
+    for t in range(queries.shape[1]):
+        cost = np.linalg.norm(
+            references - queries[:, t, None, :].astype(np.float64), axis=2
+        )
+        cum_cost = np.cumsum(cost, axis=1)
+        if row is None:
+            row = cum_cost
+            continue
+        best_prev = row.copy()
+        best_prev[:, 1:] = np.minimum(row[:, 1:], row[:, :-1])
+        new_row = cum_cost + np.minimum.accumulate(
+            best_prev + cost - cum_cost, axis=1
+        )
+        active = (t < query_lengths)[:, None]
+        row = np.where(active, new_row, row)
+    dtw = np.full(n, np.nan)
+    valid = reference_lengths > 0
+    dtw[valid] = row[np.arange(n)[valid], reference_lengths[valid] - 1]
+    return dtw
+
+
+def _coverage(
+    paths: ndarray,
+    path_mask: ndarray,
+    references: ndarray,
+    reference_mask: ndarray,
+    threshold: float,
+) -> ndarray:
+    """Path coverage PC = mean_r exp(-min_p ||r - p|| / threshold)."""
+    sq = (
+        np.sum(references**2, axis=2)[:, :, None]
+        + np.sum(paths**2, axis=2)[:, None, :]
+        - 2.0 * np.einsum("bmd,btd->bmt", references, paths)
+    )
+    sq = np.where(path_mask[:, None, :], np.maximum(sq, 0.0), np.inf)
+    score = np.exp(-np.sqrt(sq.min(axis=2)) / threshold) * reference_mask
+    count = reference_mask.sum(axis=1)
+    return np.divide(
+        score.sum(axis=1),
+        count,
+        out=np.full(len(count), np.nan),
+        where=count > 0,
+    )
+
+
+def compute_metrics(
+    trajectories: Dict[str, ndarray],
+    success_distance: float = 3.0,
+    dtw_scale: float = 3.0,
+    batch_size: int = 256,
+    gt_store: Optional[GTStore] = None,
+) -> Dict[str, ndarray]:
+    """Computes per-episode SR, SPL, OS, NE, PL, nDTW, SDTW and CLS from the
+    columns written by `TrajectoryRecorder`. Distances to goal come from the
+    recorded `distance_to_goal` column, so SPL's shortest-path length is the
+    geodesic distance at the start pose, as in the online SPL measure.
+    nDTW and SDTW use the dense GT locations of `gt_store`, like the online
+    NDTW measure (nan for episodes it lacks); without a store they fall back
+    to the sparse reference path. CLS always uses the reference path.
+    """
+    offsets = trajectories["offsets"]
+    ref_offsets = trajectories["ref_offsets"]
+    positions = trajectories["positions"].astype(np.float64)
+    distances = trajectories["distance_to_goal"].astype(np.float64)
+    actions = trajectories["actions"]
+    reference_path = trajectories["reference_path"].astype(np.float64)
+
+    starts, ends = _segment_ends(offsets)
+    last = ends - 1
+    distance_to_goal = distances[last]
+    stop_called = (ends - starts > 1) & (
+        actions[np.maximum(last - 1, starts)] == STOP
+    )
+    success = (stop_called & (distance_to_goal < success_distance)).astype(
+        np.float64
+    )
+    oracle_success = (
+        np.minimum.reduceat(distances, starts) < success_distance
+    ).astype(np.float64)
+
+    path_length = _path_lengths(positions, offsets)
+    start_distance = distances[starts]
+    spl = success * np.divide(
+        start_distance,
+        np.maximum(start_distance, path_length),
+        out=np.ones_like(start_distance),
+        where=np.maximum(start_distance, path_length) > 0,
+    )
+
+    ref_starts, ref_ends = _segment_ends(ref_offsets)
+    ref_lengths = ref_ends - ref_starts
+    ref_path_length = _path_lengths(reference_path, ref_offsets)
+
+    if gt_store is None:
+        dtw_reference, dtw_ref_offsets = reference_path, ref_offsets
+    else:
+        gt_locations = [
+            np.asarray(gt_store.locations(episode_id), dtype=np.float64)
+            if episode_id in gt_store else np.zeros((0, 3))
+            for episode_id in trajectories["episode_id"]
+        ]
+        dtw_reference = (
+            np.concatenate(gt_locations) if gt_locations else np.zeros((0, 3))
+        )
+        dtw_ref_offsets = np.concatenate(
+            [[0], np.cumsum([len(g) for g in gt_locations])]
+        ).astype(np.int64)
+    dtw_ref_starts, dtw_ref_ends = _segment_ends(dtw_ref_offsets)
+    dtw_ref_lengths = dtw_ref_ends - dtw_ref_starts
+
+    dedup_positions, dedup_offsets = _dedup_consecutive(positions, offsets)
+    dedup_starts, dedup_ends = _segment_ends(dedup_offsets)
+
+    ndtw = np.full(len(starts), np.nan)
+    cls = np.full(len(starts), np.nan)
+    for b in range(0, len(starts), batch_size):
+        sl = slice(b, b + batch_size)
+        refs, ref_mask = _pad_segments(
+            reference_path, ref_starts[sl], ref_lengths[sl]
+        )
+        dtw_refs, _ = _pad_segments(
+            dtw_reference, dtw_ref_starts[sl], dtw_ref_lengths[sl]
+        )
+        queries, _ = _pad_segments(
+            dedup_positions,
+            dedup_starts[sl],
+            dedup_ends[sl] - dedup_starts[sl],
+        )
+        dtw = batch_dtw(
+            queries, dedup_ends[sl] - dedup_starts[sl], dtw_refs, dtw_ref_lengths[sl]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndtw[sl] = np.exp(-dtw / (dtw_ref_lengths[sl] * dtw_scale))
+
+        paths, path_mask = _pad_segments(
+            positions, starts[sl], ends[sl] - starts[sl]
+        )
+        pc = _coverage(paths, path_mask, refs, ref_mask, success_distance)
+        epl = pc * ref_path_length[sl]
+        denominator = epl + np.abs(epl - path_length[sl])
+        ls = np.divide(
+            epl,
+            denominator,
+            out=np.zeros_like(epl),
+            where=denominator > 0,
+        )
+        cls[sl] = pc * ls
+
+    return {
+        "success": success,
+        "spl": spl,
+        "oracle_success": oracle_success,
+        "distance_to_goal": distance_to_goal,
+        "path_length": path_length,
+        "ndtw": ndtw,
+        "sdtw": success * ndtw,
+        "cls": cls,
+    }
+
+
+def summarize(metrics: Dict[str, ndarray]) -> Dict[str, float]:
+    summary = {k: float(np.nanmean(v)) for k, v in metrics.items()}
+    summary["length"] = len(metrics["success"])
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute VLN metrics offline from recorded trajectories."
+    )
+    parser.add_argument(
+        "trajectories", type=str, help="directory, glob or .npz file"
+    )
+    parser.add_argument("--success_distance", type=float, default=3.0)
+    parser.add_argument("--gt_path", type=str, default=DEFAULT_GT_PATH,
+                        help="GT locations for nDTW/SDTW; empty for the reference path")
+    parser.add_argument("--output", type=str, default=None,
+                        help="optional per-episode metrics json lines")
+    args = parser.parse_args()
+
+    trajectories = load_trajectories(args.trajectories)
+    metrics = compute_metrics(
+        trajectories,
+        success_distance=args.success_distance,
+        gt_store=load_gt_store(args.gt_path) if args.gt_path else None,
+    )
+    print(summarize(metrics))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            for i, episode_id in enumerate(trajectories["episode_id"]):
+                res = {
+                    "scene_id": str(trajectories["scene_id"][i]),
+                    "episode_id": str(episode_id),
+                }
+                res.update({k: float(v[i]) for k, v in metrics.items()})
+                f.write(json.dumps(res) + "\n")
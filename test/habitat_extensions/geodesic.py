@@ -0,0 +1,133 @@
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from habitat.core.dataset import Episode
+from habitat.core.simulator import Simulator
+from numpy import ndarray
+
+GoalKey = Tuple[Tuple[int, int, int], ...]
+CellKey = Tuple[int, int, int]
+
+
+class GeodesicDistanceCache:
+    """Geodesic distance to an episode's goals, memoised per (scene, goals).
+
+    Positions are snapped to a `resolution` grid in x/z before lookup, so
+    repeated poses on the 0.25m / 15 degree action lattice (turning in place,
+    revisiting a cell) and episodes that share a goal in the same scene hit
+    the same table. The height only selects a floor (`floor_height` bands),
+    since the agent's y follows the navmesh and would otherwise split a cell.
+    The returned distance is the one computed for the first position seen in
+    a cell, i.e. it is exact up to `resolution`.
+
+    A table can also be filled up front with `precompute`, which evaluates
+    the navigable points of a floor on a coarse grid.
+    """
+
+    def __init__(
+        self,
+        resolution: float = 0.01,
+        max_tables: int = 64,
+        floor_height: float = 1.5,
+    ):
+        self.resolution = resolution
+        self.floor_height = floor_height
+        self.max_tables = max_tables
+        self._tables: "OrderedDict[Tuple[str, GoalKey], Dict[CellKey, float]]" = (
+            OrderedDict()
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def _cell(self, position: ndarray) -> CellKey:
+        x, y, z = np.asarray(position, dtype=np.float64)
+        return (
+            int(round(x / self.resolution)),
+            int(round(y / self.floor_height)),
+            int(round(z / self.resolution)),
+        )
+
+    @staticmethod
+    def _goal_key(episode: Episode) -> GoalKey:
+        return tuple(
+            tuple(np.round(np.asarray(goal.position) * 100).astype(int).tolist())
+            for goal in episode.goals
+        )
+
+    def _table(self, episode: Episode) -> Dict[CellKey, float]:
+        key = (episode.scene_id, self._goal_key(episode))
+        table = self._tables.get(key)
+        if table is None:
+            table = self._tables[key] = {}
+            if len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+        else:
+            self._tables.move_to_end(key)
+        return table
+
+    def distance(
+        self, sim: Simulator, episode: Episode, position: ndarray
+    ) -> float:
+        table = self._table(episode)
+        cell = self._cell(position)
+        distance = table.get(cell)
+        if distance is None:
+            self.misses += 1
+            distance = sim.geodesic_distance(
+                position, [goal.position for goal in episode.goals], episode
+            )
+            table[cell] = distance
+        else:
+            self.hits += 1
+        return distance
+
+    def precompute(
+        self,
+        sim: Simulator,
+        episode: Episode,
+        height: Optional[float] = None,
+        step: float = 0.25,
+    ) -> int:
+        """Fills the (scene, goals) table with the geodesic distance of the
+        navigable points of the floor at `height` (default: the episode start
+        height) on a `step` grid anchored at the start position, i.e. the
+        poses reachable by forward moves along the grid axes. Other poses are
+        still computed on first use. Returns the number of points evaluated.
+        """
+        start = np.asarray(episode.start_position, dtype=np.float64)
+        if height is None:
+            height = start[1]
+        table = self._table(episode)
+        goals = [goal.position for goal in episode.goals]
+        lower, upper = sim.pathfinder.get_bounds()
+        xs = start[0] + step * np.arange(
+            np.ceil((lower[0] - start[0]) / step),
+            np.floor((upper[0] - start[0]) / step) + 1,
+        )
+        zs = start[2] + step * np.arange(
+            np.ceil((lower[2] - start[2]) / step),
+            np.floor((upper[2] - start[2]) / step) + 1,
+        )
+        n = 0
+        for x in xs:
+            for z in zs:
+                point = np.array([x, height, z], dtype=np.float32)
+                if not sim.pathfinder.is_navigable(point):
+                    continue
+                # key on the navmesh height the agent would report there
+                point = np.asarray(sim.pathfinder.snap_point(point), dtype=np.float32)
+                cell = self._cell(point)
+                if cell not in table:
+                    table[cell] = sim.geodesic_distance(point, goals, episode)
+                    n += 1
+        return n
+
+    def clear(self) -> None:
+        self._tables.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Shared by every CachedDistanceToGoal instance in the process.
+GEODESIC_CACHE = GeodesicDistanceCache()
@@ -0,0 +1,192 @@
+import argparse
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+from numpy import ndarray
+
+STORE_SUFFIX = ".store"
+# ground truth read by the online NDTW measure
+DEFAULT_GT_PATH = "data/datasets/rxr/val_unseen/val_unseen_guide_gt.json.gz"
+
+_OFFSETS_FILE = "offsets.npy"
+_LOCATIONS_FILE = "locations.npy"
+_ACTIONS_FILE = "actions.npy"
+
+_STORES: Dict[str, "GTStore"] = {}
+
+
+def store_path_for(gt_path: str) -> str:
+    """`path/to/{split}_gt.json.gz` -> `path/to/{split}_gt.store`"""
+    base = gt_path
+    for ext in (".gz", ".json"):
+        if base.endswith(ext):
+            base = base[: -len(ext)]
+    return base + STORE_SUFFIX
+
+
+def convert_gt_json(gt_path: str, store_path: Optional[str] = None) -> str:
+    """Converts a VLN-CE ground-truth file ({episode_id: {"locations": ...,
+    "actions": ...}}) into a directory of flat .npy arrays:
+        offsets.npy   structured (episode_id, loc_start, loc_end,
+                      act_start, act_end) table sorted by episode_id
+        locations.npy float32 (N, 3) concatenated GT locations
+        actions.npy   int8 (M,) concatenated GT actions
+    The directory is written to a temporary location and renamed into place
+    so concurrent ranks never observe a partial store.
+    """
+    if store_path is None:
+        store_path = store_path_for(gt_path)
+
+    opener = gzip.open if gt_path.endswith(".gz") else open
+    with opener(gt_path, "rt") as f:
+        gt_json = json.load(f)
+
+    episode_ids = sorted(gt_json.keys())
+    id_len = max([len(str(k)) for k in episode_ids] + [1])
+    offsets = np.zeros(
+        len(episode_ids),
+        dtype=[
+            ("episode_id", f"U{id_len}"),
+            ("loc_start", np.int64),
+            ("loc_end", np.int64),
+            ("act_start", np.int64),
+            ("act_end", np.int64),
+        ],
+    )
+    locations: List[ndarray] = []
+    actions: List[ndarray] = []
+    n_loc, n_act = 0, 0
+    for i, episode_id in enumerate(episode_ids):
+        ep = gt_json[episode_id]
+        ep_locations = np.asarray(
+            ep.get("locations", []), dtype=np.float32
+        ).reshape(-1, 3)
+        ep_actions = np.asarray(ep.get("actions", []), dtype=np.int8)
+        offsets[i] = (
+            str(episode_id),
+            n_loc,
+            n_loc + len(ep_locations),
+            n_act,
+            n_act + len(ep_actions),
+        )
+        n_loc += len(ep_locations)
+        n_act += len(ep_actions)
+        locations.append(ep_locations)
+        actions.append(ep_actions)
+
+    parent = os.path.dirname(os.path.abspath(store_path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".gt_store_")
+    try:
+        np.save(os.path.join(tmp_dir, _OFFSETS_FILE), offsets)
+        np.save(
+            os.path.join(tmp_dir, _LOCATIONS_FILE),
+            np.concatenate(locations) if locations else np.zeros((0, 3), np.float32),
+        )
+        np.save(
+            os.path.join(tmp_dir, _ACTIONS_FILE),
+            np.concatenate(actions) if actions else np.zeros(0, np.int8),
+        )
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    if os.path.isdir(store_path) and not is_stale(gt_path, store_path):
+        # another rank finished the conversion first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return store_path
+    if os.path.isdir(store_path):
+        # replacing a stale store: move it aside, then swap in the new one
+        stale_dir = tempfile.mkdtemp(dir=parent, prefix=".gt_store_stale_")
+        try:
+            os.rename(store_path, os.path.join(stale_dir, "store"))
+        except OSError:
+            # another rank moved it aside first
+            pass
+        shutil.rmtree(stale_dir, ignore_errors=True)
+    try:
+        os.rename(tmp_dir, store_path)
+    except OSError:
+        # another rank renamed its store into place first; reuse it
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(store_path) or is_stale(gt_path, store_path):
+            raise
+    return store_path
+
+
+class GTStore:
+    """Read-only, memory-mapped view over a converted ground-truth store.
+    The arrays are opened with `mmap_mode="r"`, so every process on a node
+    shares the same pages through the page cache.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        offsets = np.load(os.path.join(store_path, _OFFSETS_FILE))
+        self._locations = np.load(
+            os.path.join(store_path, _LOCATIONS_FILE), mmap_mode="r"
+        )
+        self._actions = np.load(
+            os.path.join(store_path, _ACTIONS_FILE), mmap_mode="r"
+        )
+        self._index = {
+            str(row["episode_id"]): i for i, row in enumerate(offsets)
+        }
+        self._offsets = offsets
+
+    def __contains__(self, episode_id) -> bool:
+        return str(episode_id) in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def keys(self) -> List[str]:
+        return list(self._index.keys())
+
+    def locations(self, episode_id) -> ndarray:
+        row = self._offsets[self._index[str(episode_id)]]
+        return self._locations[row["loc_start"] : row["loc_end"]]
+
+    def actions(self, episode_id) -> ndarray:
+        row = self._offsets[self._index[str(episode_id)]]
+        return self._actions[row["act_start"] : row["act_end"]]
+
+
+def is_stale(gt_path: str, store_path: str) -> bool:
+    """True if there is no store yet or the JSON file changed after it was
+    converted."""
+    offsets_path = os.path.join(store_path, _OFFSETS_FILE)
+    if not os.path.exists(offsets_path):
+        return True
+    if gt_path == store_path or not os.path.exists(gt_path):
+        return False
+    return os.path.getmtime(gt_path) > os.path.getmtime(offsets_path)
+
+
+def load_gt_store(gt_path: str) -> GTStore:
+    """Returns the process-wide store for `gt_path`, converting the JSON
+    file on first use if no store exists next to it yet, or if the JSON
+    file is newer than the store.
+    """
+    store_path = (
+        gt_path if gt_path.endswith(STORE_SUFFIX) else store_path_for(gt_path)
+    )
+    if store_path not in _STORES:
+        if is_stale(gt_path, store_path):
+            convert_gt_json(gt_path, store_path)
+        _STORES[store_path] = GTStore(store_path)
+    return _STORES[store_path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert {split}_gt.json.gz files into memory-mapped stores."
+    )
+    parser.add_argument("gt_paths", nargs="+", type=str)
+    args = parser.parse_args()
+    for gt_path in args.gt_paths:
+        print(f"{gt_path} -> {convert_gt_json(gt_path)}")
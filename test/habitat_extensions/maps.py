@@ -1,7 +1,13 @@
-from typing import Dict, List, Optional, Tuple, Union
+import glob
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import networkx as nx
 import numpy as np
+from scipy.spatial import cKDTree
 from habitat.core.simulator import Simulator
 from habitat.core.utils import try_cv2_import
 from habitat.tasks.vln.vln import VLNEpisode
@@ -46,8 +52,74 @@ TOP_DOWN_MAP_COLORS[MAP_ORACLE_WAYPOINT] = [255, 165, 0]  # Orange
 TOP_DOWN_MAP_COLORS[MAP_SHORTEST_PATH_WAYPOINT] = [0, 150, 0]  # Dark Green
 
 
-def get_top_down_map(sim, map_resolution, meters_per_pixel):
+# the disk cache is opt-in: set TOP_DOWN_MAP_CACHE_DIR or pass `cache_dir`
+TOP_DOWN_MAP_CACHE_DIR = os.environ.get("TOP_DOWN_MAP_CACHE_DIR")
+TOP_DOWN_MAP_LRU_SIZE = 16
+
+_TOP_DOWN_MAP_LRU: "OrderedDict[Tuple, np.ndarray]" = OrderedDict()
+
+
+def _top_down_map_key(
+    scene: str, base_height: float, map_resolution: int, meters_per_pixel: float
+) -> Tuple[str, float, int, float]:
+    scene_name = os.path.splitext(os.path.basename(scene))[0]
+    return (
+        scene_name,
+        round(float(base_height), 2),
+        int(map_resolution),
+        round(float(meters_per_pixel), 6),
+    )
+
+
+def _top_down_map_path(key: Tuple, cache_dir: str) -> str:
+    return os.path.join(cache_dir, "{}_{:.2f}_{}_{:g}.npz".format(*key))
+
+
+def load_cached_top_down_map(
+    key: Tuple[str, float, int, float], cache_dir: Optional[str]
+) -> Optional[np.ndarray]:
+    """Looks `key` up in the in-process LRU, then in `cache_dir`."""
+    if key in _TOP_DOWN_MAP_LRU:
+        _TOP_DOWN_MAP_LRU.move_to_end(key)
+        return _TOP_DOWN_MAP_LRU[key]
+
+    td_map = None
+    if cache_dir is not None:
+        path = _top_down_map_path(key, cache_dir)
+        if os.path.exists(path):
+            with np.load(path) as f:
+                td_map = f["top_down_map"]
+    if td_map is not None:
+        _remember_top_down_map(key, td_map)
+    return td_map
+
+
+def _remember_top_down_map(key: Tuple, td_map: np.ndarray) -> None:
+    _TOP_DOWN_MAP_LRU[key] = td_map
+    while len(_TOP_DOWN_MAP_LRU) > TOP_DOWN_MAP_LRU_SIZE:
+        _TOP_DOWN_MAP_LRU.popitem(last=False)
+
+
+def get_top_down_map(
+    sim,
+    map_resolution,
+    meters_per_pixel,
+    cache_dir: Optional[str] = TOP_DOWN_MAP_CACHE_DIR,
+):
+    """Navmesh top-down map at the agent's current height. The raster only
+    depends on (scene, base height, map_resolution, meters_per_pixel), so it
+    is kept in an in-process LRU and, if a `cache_dir` is given, in a
+    compressed .npz shared by all episodes and ranks on the same floor. A
+    copy is returned so callers can draw on it.
+    """
     base_height = sim.get_agent(0).state.position[1]
+    key = _top_down_map_key(
+        sim.habitat_config.scene, base_height, map_resolution, meters_per_pixel
+    )
+    td_map = load_cached_top_down_map(key, cache_dir)
+    if td_map is not None:
+        return td_map.copy()
+
     td_map = habitat_maps.get_topdown_map(
         sim.pathfinder,
         base_height,
@@ -55,7 +127,57 @@ def get_top_down_map(sim, map_resolution, meters_per_pixel):
         False,
         meters_per_pixel,
     )
-    return td_map
+    _remember_top_down_map(key, td_map)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = _top_down_map_path(key, cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz.tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                lower, upper = sim.pathfinder.get_bounds()
+                np.savez_compressed(
+                    f,
+                    top_down_map=td_map,
+                    lower=np.asarray(lower),
+                    upper=np.asarray(upper),
+                )
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return td_map.copy()
+
+
+def find_cached_top_down_map(
+    cache_dir: str,
+    scene: str,
+    base_height: float,
+    map_resolution: int,
+    tolerance: float = 0.05,
+) -> Optional[Tuple[np.ndarray, Dict[str, np.ndarray]]]:
+    """Loads the cached map of `scene` whose floor height is closest to
+    `base_height` (within `tolerance`), without needing a simulator.
+    Returns:
+        (top_down_map, bounds) with bounds in the format of `static_to_grid`,
+        or None if no matching map was cached.
+    """
+    scene_name = os.path.splitext(os.path.basename(scene))[0]
+    best, best_diff = None, tolerance
+    for path in glob.glob(
+        os.path.join(cache_dir, f"{scene_name}_*_{int(map_resolution)}_*.npz")
+    ):
+        name = os.path.basename(path)[: -len(".npz")]
+        # the glob also matches scenes whose name extends `scene_name`
+        name_part, height, _, _ = name.rsplit("_", 3)
+        if name_part != scene_name:
+            continue
+        diff = abs(float(height) - base_height)
+        if diff <= best_diff:
+            best, best_diff = path, diff
+    if best is None:
+        return None
+    with np.load(best) as f:
+        return f["top_down_map"], {"lower": f["lower"], "upper": f["upper"]}
 
 
 def colorize_top_down_map(
@@ -80,6 +202,94 @@ def colorize_top_down_map(
     return _map
 
 
+def dirty_bbox(
+    points: np.ndarray, pad: int, shape: Tuple[int, int]
+) -> Tuple[int, int, int, int]:
+    """(row_min, row_max, col_min, col_max) box, max exclusive and clipped to
+    `shape`, around the (N, 2) (row, col) `points` padded by `pad` pixels,
+    e.g. the agent cell padded by the fog-of-war visibility radius or a
+    trail segment padded by its line thickness.
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+    lo = np.maximum(points.min(axis=0) - pad, 0)
+    hi = np.minimum(points.max(axis=0) + pad + 1, shape[:2])
+    return int(lo[0]), int(hi[0]), int(lo[1]), int(hi[1])
+
+
+class IncrementalTopDownMapColorizer:
+    """Stateful `colorize_top_down_map` for consecutive frames of the same
+    episode. The colourised map, class map and fog mask of the previous
+    frame are kept, and only pixels whose class or fog state changed are
+    re-coloured. Passing the `dirty` box of the frame's updates (see
+    `dirty_bbox`) limits the diff to that region, so per-frame cost follows
+    the newly revealed area. Call `reset()` between episodes (a change of
+    map shape also resets).
+
+    The returned map is the colouriser's own buffer unless `copy=True`; copy
+    it before drawing on it.
+    """
+
+    def __init__(self, fog_of_war_desat_amount: float = 0.5):
+        self.fog_of_war_desat_values = np.array(
+            [fog_of_war_desat_amount, 1.0]
+        )
+        self.reset()
+
+    def reset(self) -> None:
+        self._map: Optional[np.ndarray] = None
+        self._classes: Optional[np.ndarray] = None
+        self._fog: Optional[np.ndarray] = None
+
+    def __call__(
+        self,
+        top_down_map: np.ndarray,
+        fog_of_war_mask: Optional[np.ndarray] = None,
+        dirty: Optional[Tuple[int, int, int, int]] = None,
+        copy: bool = False,
+    ) -> np.ndarray:
+        if self._map is None or self._map.shape[:2] != top_down_map.shape:
+            # without a mask nothing is desaturated, same as an all-visible mask
+            fog = (
+                np.ones(top_down_map.shape, dtype=bool)
+                if fog_of_war_mask is None
+                else fog_of_war_mask.astype(bool)
+            )
+            self._map = colorize_top_down_map(
+                top_down_map,
+                fog.astype(np.int64),
+                self.fog_of_war_desat_values[0],
+            )
+            self._classes = top_down_map.copy()
+            self._fog = fog
+        else:
+            if dirty is None:
+                region = (slice(None), slice(None))
+            else:
+                region = (slice(dirty[0], dirty[1]), slice(dirty[2], dirty[3]))
+            classes = top_down_map[region]
+            fog = (
+                np.ones(classes.shape, dtype=bool)
+                if fog_of_war_mask is None
+                else fog_of_war_mask[region].astype(bool)
+            )
+            changed = (classes != self._classes[region]) | (fog != self._fog[region])
+            rows, cols = np.nonzero(changed)
+            changed_classes = classes[rows, cols]
+            colors = TOP_DOWN_MAP_COLORS[changed_classes]
+            # Only desaturate valid points as only valid points get revealed
+            desat = changed_classes != MAP_INVALID_POINT
+            colors[desat] = (
+                colors[desat]
+                * self.fog_of_war_desat_values[
+                    fog[rows, cols][desat].astype(np.int64)
+                ][:, None]
+            ).astype(np.uint8)
+            self._map[region][rows, cols] = colors
+            self._classes[region] = classes
+            self._fog[region] = fog
+        return self._map.copy() if copy else self._map
+
+
 def static_to_grid(
     realworld_x: float,
     realworld_y: float,
@@ -102,6 +312,34 @@ def static_to_grid(
     return grid_x, grid_y
 
 
+def sim_bounds(sim: Simulator) -> Dict[str, Tuple[float, float]]:
+    """The pathfinder bounds of `sim` in the format of `static_to_grid`."""
+    lower, upper = sim.pathfinder.get_bounds()
+    return {"lower": lower, "upper": upper}
+
+
+def points_to_grid(
+    points: Union[np.ndarray, List[List[float]]],
+    grid_resolution: Tuple[int, int],
+    bounds: Dict[str, Tuple[float, float]],
+) -> np.ndarray:
+    """Vectorised `static_to_grid` for an (N, 3) array of [x, y, z] points.
+    Returns an (N, 2) int array of (grid_x, grid_y) rows, i.e. the same
+    values as `habitat_maps.to_grid(p[2], p[0], ...)` for each point.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    lower = np.asarray(bounds["lower"], dtype=np.float64)
+    upper = np.asarray(bounds["upper"], dtype=np.float64)
+    grid_size = np.array(
+        [
+            abs(upper[2] - lower[2]) / grid_resolution[0],
+            abs(upper[0] - lower[0]) / grid_resolution[1],
+        ]
+    )
+    grid = (points[:, [2, 0]] - lower[[2, 0]]) / grid_size
+    return grid.astype(np.int64)
+
+
 def drawline(
     img: np.ndarray,
     pt1: Union[Tuple[float], List[float]],
@@ -141,6 +379,50 @@ def drawline(
                 cv2.line(img, s, e, color, thickness)
 
 
+def drawpolyline(
+    img: np.ndarray,
+    points: np.ndarray,
+    color: List[int],
+    thickness: int = 1,
+    style: str = "dashed",
+    gap: int = 15,
+) -> None:
+    """Same result as calling `drawline` between each pair of consecutive
+    (x, y) `points`, but the dash/dot samples of all segments are computed
+    with NumPy and the lines are rasterised by a single cv2 call.
+    """
+    assert style in ["dotted", "dashed", "filled"]
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) < 2:
+        return
+
+    if style == "filled":
+        cv2.polylines(
+            img, [points.astype(np.int32)], False, color, thickness
+        )
+        return
+
+    pt1, pt2 = points[:-1], points[1:]
+    dist = np.linalg.norm(pt2 - pt1, axis=1)
+    n_samples = np.ceil(dist / gap).astype(np.int64)
+    seg = np.repeat(np.arange(len(dist)), n_samples)
+    # index of each sample within its own segment
+    first = np.concatenate([[0], np.cumsum(n_samples)[:-1]])
+    step = np.arange(len(seg)) - np.repeat(first, n_samples)
+    r = (step * gap / dist[seg])[:, None]
+    pts = (pt1[seg] * (1 - r) + pt2[seg] * r + 0.5).astype(np.int32)
+
+    if style == "dotted":
+        for p in pts:
+            cv2.circle(img, (int(p[0]), int(p[1])), thickness, color, -1)
+    else:
+        # a dash joins sample i - 1 to sample i for odd i of each segment
+        odd = np.flatnonzero(step % 2 == 1)
+        dashes = np.stack([pts[odd - 1], pts[odd]], axis=1)
+        if len(dashes):
+            cv2.polylines(img, list(dashes), False, color, thickness)
+
+
 def drawpoint(
     img: np.ndarray,
     position: Union[Tuple[int], List[int]],
@@ -155,6 +437,30 @@ def drawpoint(
     ] = color
 
 
+def drawpoints(
+    img: np.ndarray,
+    positions: np.ndarray,
+    color: List[int],
+    meters_per_px: float,
+    pad: float = 0.3,
+) -> None:
+    """Vectorised `drawpoint` for an (N, 2) array of (row, col) positions.
+    Squares are clipped to the image instead of wrapping around.
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+    if len(positions) == 0:
+        return
+    point_padding = int(pad / meters_per_px)
+    offsets = np.arange(-point_padding, point_padding + 1)
+    rows = positions[:, 0, None, None] + offsets[None, :, None]
+    cols = positions[:, 1, None, None] + offsets[None, None, :]
+    rows, cols = np.broadcast_arrays(rows, cols)
+    valid = (
+        (rows >= 0) & (rows < img.shape[0]) & (cols >= 0) & (cols < img.shape[1])
+    )
+    img[rows[valid], cols[valid]] = color
+
+
 def draw_triangle(
     img: np.ndarray,
     centroid: Union[Tuple[int], List[int]],
@@ -179,35 +485,22 @@ def draw_reference_path(
     meters_per_px: float,
 ) -> None:
     """Draws lines between each waypoint in the reference path."""
-    shortest_path_points = [
-        habitat_maps.to_grid(
-            p[2],
-            p[0],
-            img.shape[0:2],
-            sim,
-        )[::-1]
-        for p in episode.reference_path
-    ]
-
-    pt_from = None
-    for i, pt_to in enumerate(shortest_path_points):
-
-        if i != 0:
-            drawline(
-                img,
-                (pt_from[0], pt_from[1]),
-                (pt_to[0], pt_to[1]),
-                MAP_SHORTEST_PATH_WAYPOINT,
-                thickness=int(0.4 * map_resolution / MAP_THICKNESS_SCALAR),
-                style="dashed",
-                gap=10,
-            )
-        pt_from = pt_to
+    # (grid_x, grid_y) == (row, col)
+    shortest_path_points = points_to_grid(
+        episode.reference_path, img.shape[0:2], sim_bounds(sim)
+    )
 
-    for pt in shortest_path_points:
-        drawpoint(
-            img, (pt[1], pt[0]), MAP_SHORTEST_PATH_WAYPOINT, meters_per_px
-        )
+    drawpolyline(
+        img,
+        shortest_path_points[:, ::-1],
+        MAP_SHORTEST_PATH_WAYPOINT,
+        thickness=int(0.4 * map_resolution / MAP_THICKNESS_SCALAR),
+        style="dashed",
+        gap=10,
+    )
+    drawpoints(
+        img, shortest_path_points, MAP_SHORTEST_PATH_WAYPOINT, meters_per_px
+    )
 
 
 def draw_straight_shortest_path_points(
@@ -219,16 +512,16 @@ def draw_straight_shortest_path_points(
     """Draws the shortest path from start to goal assuming a standard
     discrete action space.
     """
-    shortest_path_points = [
-        habitat_maps.to_grid(p[2], p[0], img.shape[0:2], sim)[::-1]
-        for p in shortest_path_points
-    ]
+    shortest_path_points = points_to_grid(
+        shortest_path_points, img.shape[0:2], sim_bounds(sim)
+    )
 
-    habitat_maps.draw_path(
+    drawpolyline(
         img,
-        [(p[1], p[0]) for p in shortest_path_points],
+        shortest_path_points[:, ::-1],
         MAP_SHORTEST_PATH_WAYPOINT,
-        int(0.4 * map_resolution / MAP_THICKNESS_SCALAR),
+        thickness=int(0.4 * map_resolution / MAP_THICKNESS_SCALAR),
+        style="filled",
     )
 
 
@@ -274,24 +567,61 @@ def draw_oracle_waypoint(
     draw_triangle(img, (w_x, w_y), MAP_ORACLE_WAYPOINT, meters_per_px, pad=0.2)
 
 
+class NavGraphIndex:
+    """Cached (N, 2) [x, z] node coordinates of an MP3D nav-graph plus a
+    KD-tree over them for nearest-node queries.
+    """
+
+    def __init__(self, graph: nx.Graph):
+        self.nodes = list(graph)
+        self.node_to_idx = {node: i for i, node in enumerate(self.nodes)}
+        self.positions = np.array(
+            [graph.nodes[node]["position"] for node in self.nodes],
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        self.xz = self.positions[:, [0, 2]]
+        self.tree = cKDTree(self.xz)
+
+    def nearest(self, positions: np.ndarray) -> np.ndarray:
+        """Indices of the nearest node for each [x, z] row of `positions`."""
+        _, idx = self.tree.query(np.asarray(positions, dtype=np.float64))
+        return idx
+
+
+_NAV_GRAPH_INDEXES: "weakref.WeakKeyDictionary[nx.Graph, NavGraphIndex]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_nav_graph_index(graph: nx.Graph) -> NavGraphIndex:
+    """Returns the spatial index of `graph`, rebuilding it if nodes were
+    added or removed since it was cached.
+    """
+    index = _NAV_GRAPH_INDEXES.get(graph)
+    if index is None or len(index.nodes) != graph.number_of_nodes():
+        index = _NAV_GRAPH_INDEXES[graph] = NavGraphIndex(graph)
+    return index
+
+
+def get_nearest_nodes(
+    graph: nx.Graph, positions: Sequence[Sequence[float]]
+) -> List[str]:
+    """Batched `get_nearest_node` for an (M, 2) array of [x,z] positions.
+    Returns:
+        node IDs
+    """
+    index = get_nav_graph_index(graph)
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+    return [index.nodes[i] for i in index.nearest(positions)]
+
+
 def get_nearest_node(graph: nx.Graph, current_position: List[float]) -> str:
     """Determine the closest MP3D node to the agent's start position as given
     by a [x,z] position vector.
     Returns:
         node ID
     """
-    nearest = None
-    dist = float("inf")
-    for node in graph:
-        node_pos = graph.nodes[node]["position"]
-        node_pos = np.take(node_pos, (0, 2))
-        cur_dist = np.linalg.norm(
-            np.array(node_pos) - np.array(current_position), ord=2
-        )
-        if cur_dist < dist:
-            dist = cur_dist
-            nearest = node
-    return nearest
+    return get_nearest_nodes(graph, [current_position])[0]
 
 
 def update_nearest_node(
@@ -303,19 +633,13 @@ def update_nearest_node(
     Returns:
         node ID
     """
-    nearest = None
-    dist = float("inf")
-
-    for node in [nearest_node] + [e[1] for e in graph.edges(nearest_node)]:
-        node_pos = graph.nodes[node]["position"]
-        node_pos = np.take(node_pos, (0, 2))
-        cur_dist = np.linalg.norm(
-            np.array(node_pos) - np.array(current_position), ord=2
-        )
-        if cur_dist < dist:
-            dist = cur_dist
-            nearest = node
-    return nearest
+    index = get_nav_graph_index(graph)
+    candidates = [nearest_node] + [e[1] for e in graph.edges(nearest_node)]
+    idx = [index.node_to_idx[node] for node in candidates]
+    dist = np.linalg.norm(
+        index.xz[idx] - np.asarray(current_position, dtype=np.float64), axis=1
+    )
+    return candidates[int(np.argmin(dist))]
 
 
 def draw_mp3d_nodes(
@@ -325,22 +649,28 @@ def draw_mp3d_nodes(
     graph: nx.Graph,
     meters_per_px: float,
 ) -> None:
+    index = get_nav_graph_index(graph)
     n = get_nearest_node(
         graph, (episode.start_position[0], episode.start_position[2])
     )
     starting_height = graph.nodes[n]["position"][1]
-    for node in graph:
-        pos = graph.nodes[node]["position"]
 
-        # no obvious way to differentiate between floors. Use this for now.
-        if abs(pos[1] - starting_height) < 1.0:
-            r_x, r_y = habitat_maps.to_grid(
-                pos[2], pos[0], img.shape[0:2], sim
-            )
+    # no obvious way to differentiate between floors. Use this for now.
+    positions = index.positions[
+        np.abs(index.positions[:, 1] - starting_height) < 1.0
+    ]
+    grid = points_to_grid(positions, img.shape[0:2], sim_bounds(sim))
+    in_map = (
+        (grid[:, 0] >= 0)
+        & (grid[:, 0] < img.shape[0])
+        & (grid[:, 1] >= 0)
+        & (grid[:, 1] < img.shape[1])
+    )
+    grid = grid[in_map]
 
-            # only paint if over a valid point
-            if img[r_x, r_y]:
-                drawpoint(img, (r_x, r_y), MAP_MP3D_WAYPOINT, meters_per_px)
+    # only paint if over a valid point
+    grid = grid[img[grid[:, 0], grid[:, 1]] != 0]
+    drawpoints(img, grid, MAP_MP3D_WAYPOINT, meters_per_px)
 
 
 from typing import Tuple
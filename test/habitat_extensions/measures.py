@@ -1,8 +1,5 @@
-import gzip
-import json
 import pickle
 from typing import Any, List, Union, Optional, Tuple
-from fastdtw import fastdtw
 import numpy as np
 # from dtw import dtw
 # from fastdtw import fastdtw
@@ -20,6 +17,9 @@ from habitat.utils.visualizations import fog_of_war
 from habitat.utils.visualizations import maps as habitat_maps
 from numpy import ndarray
 from omegaconf import DictConfig
+
+from habitat_extensions.geodesic import GEODESIC_CACHE
+from habitat_extensions.gt_store import DEFAULT_GT_PATH, load_gt_store
 # from utils import maps
 # from habitat_extensions.task import RxRVLNCEDatasetV1
 
@@ -32,6 +32,86 @@ def euclidean_distance(
     return np.linalg.norm(np.array(pos_b) - np.array(pos_a), ord=2)
 
 
+@registry.register_measure
+class AgentStateSnapshot(Measure):
+    """Agent position and rotation, read from the simulator once per step.
+    Measures that need the agent pose depend on this one instead of calling
+    `sim.get_agent_state()` themselves, so it must be listed before them.
+    """
+
+    cls_uuid: str = "agent_state"
+
+    def __init__(self, sim: Simulator, *args: Any, **kwargs: Any):
+        self._sim = sim
+        super().__init__(**kwargs)
+
+    def _get_uuid(self, *args: Any, **kwargs: Any) -> str:
+        return self.cls_uuid
+
+    def reset_metric(self, *args: Any, **kwargs: Any):
+        self.update_metric()
+
+    def update_metric(self, *args: Any, **kwargs: Any):
+        agent_state = self._sim.get_agent_state()
+        self._metric = {
+            "position": agent_state.position,
+            "rotation": agent_state.rotation,
+        }
+
+
+def add_agent_state_measure(config: DictConfig) -> None:
+    """Registers AgentStateSnapshot as the first measurement of `config`
+    (inside `habitat.config.read_write`), keeping its other measurements in
+    order, so measures depending on `agent_state` always see this step's
+    pose whatever the YAML defaults put first.
+    """
+    from habitat.config.default_structured_configs import MeasurementConfig
+
+    measurements = config.habitat.task.measurements
+    agent_state = measurements.get(AgentStateSnapshot.cls_uuid)
+    if agent_state is None:
+        agent_state = MeasurementConfig(type="AgentStateSnapshot")
+    others = {
+        name: measurements[name]
+        for name in list(measurements.keys())
+        if name != AgentStateSnapshot.cls_uuid
+    }
+    for name in list(measurements.keys()):
+        measurements.pop(name)
+    measurements[AgentStateSnapshot.cls_uuid] = agent_state
+    measurements.update(others)
+
+
+def get_agent_position(task: EmbodiedTask) -> ndarray:
+    return task.measurements.measures[AgentStateSnapshot.cls_uuid].get_metric()[
+        "position"
+    ]
+
+
+@registry.register_measure
+class CachedDistanceToGoal(DistanceToGoal):
+    """Drop-in replacement for DistanceToGoal (same uuid) that reads
+    geodesic distances through the process-wide `GEODESIC_CACHE`, keyed by
+    snapped position and goal, so Success, OracleSuccess,
+    OracleNavigationError and PL keep working unchanged.
+    """
+
+    def reset_metric(self, episode, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        task.measurements.check_measure_dependencies(
+            self.uuid, [AgentStateSnapshot.cls_uuid]
+        )
+        super().reset_metric(episode, *args, task=task, **kwargs)
+
+    def update_metric(self, episode, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        if self._config.distance_to != "POINT":
+            return super().update_metric(episode, *args, task=task, **kwargs)
+
+        current_position = get_agent_position(task)
+        self._metric = GEODESIC_CACHE.distance(
+            self._sim, episode, current_position
+        )
+
+
 @registry.register_measure
 class PathLength(Measure):
     """Path Length (PL)
@@ -48,12 +128,15 @@ class PathLength(Measure):
     def _get_uuid(self, *args: Any, **kwargs: Any) -> str:
         return self.cls_uuid
 
-    def reset_metric(self, *args: Any, **kwargs: Any):
-        self._previous_position = self._sim.get_agent_state().position
+    def reset_metric(self, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        task.measurements.check_measure_dependencies(
+            self.uuid, [AgentStateSnapshot.cls_uuid]
+        )
+        self._previous_position = get_agent_position(task)
         self._metric = 0.0
 
-    def update_metric(self, *args: Any, **kwargs: Any):
-        current_position = self._sim.get_agent_state().position
+    def update_metric(self, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        current_position = get_agent_position(task)
         self._metric += euclidean_distance(
             current_position, self._previous_position
         )
@@ -166,10 +249,15 @@ class PL(Measure):
 
     def reset_metric(self, episode, task, *args: Any, **kwargs: Any):
         task.measurements.check_measure_dependencies(
-            self.uuid, [DistanceToGoal.cls_uuid, Success.cls_uuid]
+            self.uuid,
+            [
+                AgentStateSnapshot.cls_uuid,
+                DistanceToGoal.cls_uuid,
+                Success.cls_uuid,
+            ],
         )
 
-        self._previous_position = self._sim.get_agent_state().position
+        self._previous_position = get_agent_position(task)
         self._agent_episode_distance = 0.0
         self._start_end_episode_distance = task.measurements.measures[
             DistanceToGoal.cls_uuid
@@ -186,7 +274,7 @@ class PL(Measure):
     ):
         # ep_success = task.measurements.measures[Success.cls_uuid].get_metric()
 
-        current_position = self._sim.get_agent_state().position
+        current_position = get_agent_position(task)
         self._agent_episode_distance += self._euclidean_distance(
             current_position, self._previous_position
         )
@@ -221,8 +309,57 @@ class StepsTaken(Measure):
 
 
 
+class IncrementalDTW:
+    """Exact DTW between a growing query path and a fixed reference path.
+
+    Only the last row of the DP table (one cell per reference point) is kept.
+    Appending a query point extends the table by one row in O(len(reference))
+    using the identity row[j] = C[j] + min_{k<=j}(a[k] - C[k]), where C is the
+    cumulative point-to-reference cost and a[k] the best diagonal/vertical
+    predecessor of cell k.
+    """
+
+    def __init__(self, reference: Union[List[List[float]], ndarray]):
+        self.reference = np.asarray(reference, dtype=np.float64)
+        self._row: Optional[ndarray] = None
+
+    def reset(self) -> None:
+        self._row = None
+
+    def append(self, point: Union[List[float], ndarray]) -> float:
+        cost = np.linalg.norm(
+            self.reference - np.asarray(point, dtype=np.float64), axis=1
+        )
+        cum_cost = np.cumsum(cost)
+        if self._row is None:
+            self._row = cum_cost
+        else:
+            best_prev = self._row.copy()
+            best_prev[1:] = np.minimum(self._row[1:], self._row[:-1])
+            self._row = cum_cost + np.minimum.accumulate(
+                best_prev + cost - cum_cost
+            )
+        return self.distance
+
+    @property
+    def distance(self) -> float:
+        if self._row is None:
+            return float("inf")
+        return float(self._row[-1])
+
+
 @registry.register_measure
 class NDTW(Measure):
+    """NDTW (Normalized Dynamic Time Warping)
+
+    ref: Effective and General Evaluation for Instruction Conditioned
+      Navigation using Dynamic Time Warping - Magalhaes et. al
+    https://arxiv.org/pdf/1907.05446.pdf
+
+    The DTW table is extended by one row per new agent position rather than
+    recomputed over the whole path, so each step costs O(len(gt_locations)).
+    """
+
     cls_uuid: str = "ndtw"
 
     def __init__(
@@ -230,30 +367,54 @@ class NDTW(Measure):
     ):
         self._sim = sim
         self._config = config
-        self.dtw_func = fastdtw
-        self.gt_path = "data/datasets/rxr/val_unseen/val_unseen_guide_gt.json.gz"
-        with gzip.open(self.gt_path, "rt") as f:
-            self.gt_json = json.load(f)
+        self.gt_path = DEFAULT_GT_PATH
+        self.gt_store = load_gt_store(self.gt_path)
         super().__init__()
 
     def _get_uuid(self, *args: Any, **kwargs: Any) -> str:
         return self.cls_uuid
 
-    def reset_metric(self, *args: Any, episode, **kwargs: Any):
+    def reset_metric(self, *args: Any, episode, task, **kwargs: Any):
+        task.measurements.check_measure_dependencies(
+            self.uuid, [AgentStateSnapshot.cls_uuid]
+        )
         self.locations = []
-        self.gt_locations = self.gt_json[episode.episode_id]["locations"]
-        self.update_metric()
+        self.gt_locations = self.gt_store.locations(episode.episode_id)
+        self._dtw = IncrementalDTW(self.gt_locations)
+        self.update_metric(task=task)
 
-    def update_metric(self, *args: Any, **kwargs: Any):
-        current_position = self._sim.get_agent_state().position.tolist()
+    def update_metric(self, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        current_position = get_agent_position(task).tolist()
         if not self.locations or current_position != self.locations[-1]:
             self.locations.append(current_position)
-        
-        dtw_distance = self.dtw_func(
-            self.locations, self.gt_locations, dist=euclidean_distance
-        )[0]
+            self._dtw.append(current_position)
+
         # The scale factor (3.0) is based on the default VLN-CE config.
-        nDTW = np.exp(-dtw_distance / (len(self.gt_locations) * 3.0))
+        nDTW = np.exp(-self._dtw.distance / (len(self.gt_locations) * 3.0))
         self._metric = nDTW
 
 
+@registry.register_measure
+class SDTW(Measure):
+    """SDTW (Success Weighted by nDTW)
+
+    ref: Effective and General Evaluation for Instruction Conditioned
+      Navigation using Dynamic Time Warping - Magalhaes et. al
+    https://arxiv.org/pdf/1907.05446.pdf
+    """
+
+    cls_uuid: str = "sdtw"
+
+    def _get_uuid(self, *args: Any, **kwargs: Any) -> str:
+        return self.cls_uuid
+
+    def reset_metric(self, *args: Any, episode, task, **kwargs: Any):
+        task.measurements.check_measure_dependencies(
+            self.uuid, [NDTW.cls_uuid, Success.cls_uuid]
+        )
+        self.update_metric(episode=episode, task=task)
+
+    def update_metric(self, *args: Any, task: EmbodiedTask, **kwargs: Any):
+        ep_success = task.measurements.measures[Success.cls_uuid].get_metric()
+        nDTW = task.measurements.measures[NDTW.cls_uuid].get_metric()
+        self._metric = ep_success * nDTW
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from habitat.core.utils import try_cv2_import
+from habitat.utils.visualizations import maps as habitat_maps
+from habitat.utils.visualizations.utils import images_to_video
+
+from habitat_extensions.maps import (
+    MAP_SHORTEST_PATH_WAYPOINT,
+    MAP_SOURCE_POINT_INDICATOR,
+    MAP_TARGET_POINT_INDICATOR,
+    MAP_THICKNESS_SCALAR,
+    TOP_DOWN_MAP_CACHE_DIR,
+    IncrementalTopDownMapColorizer,
+    dirty_bbox,
+    drawpoints,
+    drawpolyline,
+    find_cached_top_down_map,
+    points_to_grid,
+)
+from habitat_extensions.trajectory import load_trajectories
+
+cv2 = try_cv2_import()
+
+# first palette index of the jet colormap in TOP_DOWN_MAP_COLORS
+TRAIL_COLOR_START = 15
+TRAIL_COLOR_RANGE = 240
+
+
+def episode_records(
+    trajectories: Dict[str, np.ndarray], indices: List[int]
+) -> List[Dict]:
+    """Slices the columnar trajectory log into one small dict per episode so
+    that only the selected episodes are sent to worker processes.
+    """
+    records = []
+    for i in indices:
+        s, e = trajectories["offsets"][i], trajectories["offsets"][i + 1]
+        rs, re = trajectories["ref_offsets"][i], trajectories["ref_offsets"][i + 1]
+        records.append(
+            {
+                "scene_id": str(trajectories["scene_id"][i]),
+                "episode_id": str(trajectories["episode_id"][i]),
+                "goal_position": trajectories["goal_position"][i],
+                "reference_path": trajectories["reference_path"][rs:re],
+                "positions": trajectories["positions"][s:e],
+                "headings": trajectories["headings"][s:e],
+            }
+        )
+    return records
+
+
+def render_episode(
+    record: Dict,
+    cache_dir: str,
+    map_resolution: int = 1024,
+) -> Optional[List[np.ndarray]]:
+    """Renders one frame per recorded pose: cached top-down map, reference
+    path, start and goal, the agent trail so far and the agent sprite.
+    Returns None if no top-down map was cached for the episode's floor.
+    """
+    positions = record["positions"]
+    cached = find_cached_top_down_map(
+        cache_dir, record["scene_id"], float(positions[0][1]), map_resolution
+    )
+    if cached is None:
+        return None
+    td_map, bounds = cached
+    td_map = td_map.copy()
+    meters_per_px = abs(bounds["upper"][0] - bounds["lower"][0]) / td_map.shape[1]
+    thickness = int(np.round(map_resolution * 2 / MAP_THICKNESS_SCALAR))
+
+    if len(record["reference_path"]):
+        ref_grid = points_to_grid(record["reference_path"], td_map.shape, bounds)
+        drawpolyline(
+            td_map,
+            ref_grid[:, ::-1],
+            MAP_SHORTEST_PATH_WAYPOINT,
+            thickness=int(0.4 * map_resolution / MAP_THICKNESS_SCALAR),
+            style="dashed",
+            gap=10,
+        )
+        drawpoints(td_map, ref_grid, MAP_SHORTEST_PATH_WAYPOINT, meters_per_px)
+
+    agent_grid = points_to_grid(positions, td_map.shape, bounds)
+    drawpoints(
+        td_map, agent_grid[:1], MAP_SOURCE_POINT_INDICATOR, meters_per_px
+    )
+    if not np.isnan(record["goal_position"]).any():
+        goal_grid = points_to_grid(record["goal_position"], td_map.shape, bounds)
+        drawpoints(td_map, goal_grid, MAP_TARGET_POINT_INDICATOR, meters_per_px)
+
+    colorizer = IncrementalTopDownMapColorizer()
+    agent_radius_px = min(td_map.shape[0:2]) / 32
+    n = len(positions)
+    frames = []
+    for t in range(n):
+        dirty = None
+        if t > 0:
+            color = TRAIL_COLOR_START + min(
+                t * TRAIL_COLOR_RANGE // max(n - 1, 1), TRAIL_COLOR_RANGE
+            )
+            cv2.line(
+                td_map,
+                tuple(int(v) for v in agent_grid[t - 1][::-1]),
+                tuple(int(v) for v in agent_grid[t][::-1]),
+                color,
+                thickness=thickness,
+            )
+            dirty = dirty_bbox(agent_grid[t - 1 : t + 1], thickness, td_map.shape)
+        # the sprite is drawn on the frame, so it must not alias the colouriser
+        frame = colorizer(td_map, dirty=dirty, copy=True)
+        frame = habitat_maps.draw_agent(
+            image=frame,
+            agent_center_coord=tuple(int(v) for v in agent_grid[t]),
+            agent_rotation=float(record["headings"][t]),
+            agent_radius_px=agent_radius_px,
+        )
+        frames.append(frame)
+    return frames
+
+
+def _render_worker(job: Tuple[Dict, str, int, str, int]) -> Optional[str]:
+    record, cache_dir, map_resolution, output_dir, fps = job
+    frames = render_episode(record, cache_dir, map_resolution)
+    name = f"{record['scene_id']}_{record['episode_id']}"
+    if frames is None:
+        print(f"no cached top-down map for {name}, skipped")
+        return None
+    images_to_video(frames, output_dir, name, fps=fps, quality=9)
+    return name
+
+
+def read_selection(
+    results_path: str, only_failures: bool
+) -> Set[Tuple[str, str]]:
+    """(scene_id, episode_id) pairs from an evaluator result.json."""
+    selected = set()
+    with open(results_path, "r") as f:
+        for line in f.readlines():
+            res = json.loads(line)
+            if "episode_id" not in res:
+                continue
+            if only_failures and res["success"] > 0.001:
+                continue
+            selected.add((str(res["scene_id"]), str(res["episode_id"])))
+    return selected
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render top-down episode videos from recorded trajectories, "
+        "without a simulator."
+    )
+    parser.add_argument("trajectories", type=str,
+                        help="trajectory directory, glob or .npz file")
+    parser.add_argument("--output_path", type=str, default="./results/vis_offline")
+    parser.add_argument("--cache_dir", type=str, default=TOP_DOWN_MAP_CACHE_DIR,
+                        required=TOP_DOWN_MAP_CACHE_DIR is None,
+                        help="top-down map cache written by get_top_down_map")
+    parser.add_argument("--map_resolution", type=int, default=1024)
+    parser.add_argument("--results", type=str, default=None,
+                        help="result.json to select episodes from")
+    parser.add_argument("--only_failures", action="store_true", default=False)
+    parser.add_argument("--episode_ids", type=str, nargs="*", default=None)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--fps", type=int, default=6)
+    args = parser.parse_args()
+
+    trajectories = load_trajectories(args.trajectories)
+    indices = list(range(len(trajectories["episode_id"])))
+    if args.results is not None:
+        selected = read_selection(args.results, args.only_failures)
+        indices = [
+            i for i in indices
+            if (str(trajectories["scene_id"][i]), str(trajectories["episode_id"][i]))
+            in selected
+        ]
+    if args.episode_ids:
+        episode_ids = set(args.episode_ids)
+        indices = [
+            i for i in indices if str(trajectories["episode_id"][i]) in episode_ids
+        ]
+
+    os.makedirs(args.output_path, exist_ok=True)
+    jobs = [
+        (record, args.cache_dir, args.map_resolution, args.output_path, args.fps)
+        for record in episode_records(trajectories, indices)
+    ]
+    print(f"rendering {len(jobs)} episodes with {args.num_workers} workers")
+    with Pool(args.num_workers) as pool:
+        for name in pool.imap_unordered(_render_worker, jobs):
+            if name is not None:
+                print(f"rendered {name}")
@@ -0,0 +1,158 @@
+import glob
+import os
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from numpy import ndarray
+
+NO_ACTION = -1
+
+# Per-pose columns. Each episode owns rows offsets[i]:offsets[i + 1]; the
+# action column holds the action taken *from* that pose (NO_ACTION on the
+# final pose). Headings are top-down map angles, as in the `agent_angle` of
+# habitat's TopDownMap measure.
+POSE_COLUMNS = {
+    "positions": (np.float32, (3,)),
+    "headings": (np.float32, ()),
+    "actions": (np.int8, ()),
+    "collisions": (np.bool_, ()),
+    "distance_to_goal": (np.float32, ()),
+}
+
+
+class TrajectoryRecorder:
+    """Collects compact per-episode trajectories during evaluation and
+    writes them as columnar .npz chunks (`trajectories_rank{r}_{k}.npz`).
+    Metrics can then be recomputed offline with
+    `habitat_extensions.batch_metrics` without re-simulating.
+    """
+
+    def __init__(self, output_dir: str, rank: int = 0, flush_every: int = 100):
+        self.output_dir = output_dir
+        self.rank = rank
+        self.flush_every = flush_every
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._chunk_id = len(
+            glob.glob(
+                os.path.join(self.output_dir, f"trajectories_rank{rank}_*.npz")
+            )
+        )
+        self._episodes: List[Dict] = []
+        self._current: Optional[Dict] = None
+
+    def start_episode(
+        self,
+        scene_id: str,
+        episode_id: Union[str, int],
+        reference_path: Optional[Sequence[Sequence[float]]] = None,
+        goal_position: Optional[Sequence[float]] = None,
+    ) -> None:
+        self._current = {
+            "scene_id": str(scene_id),
+            "episode_id": str(episode_id),
+            "goal_position": np.asarray(
+                goal_position if goal_position is not None else [np.nan] * 3,
+                dtype=np.float32,
+            ),
+            "reference_path": np.asarray(
+                reference_path if reference_path is not None else [],
+                dtype=np.float32,
+            ).reshape(-1, 3),
+            "positions": [],
+            "headings": [],
+            "actions": [],
+            "collisions": [],
+            "distance_to_goal": [],
+        }
+
+    def add_pose(
+        self,
+        position: Sequence[float],
+        heading: float,
+        distance_to_goal: float,
+        collision: bool = False,
+    ) -> None:
+        ep = self._current
+        # the previous pose never got an action -> none was taken from it
+        if len(ep["actions"]) < len(ep["positions"]):
+            ep["actions"].append(NO_ACTION)
+        ep["positions"].append(position)
+        ep["headings"].append(heading)
+        ep["distance_to_goal"].append(distance_to_goal)
+        ep["collisions"].append(collision)
+
+    def add_action(self, action: int) -> None:
+        self._current["actions"].append(action)
+
+    def end_episode(self) -> None:
+        ep = self._current
+        n = len(ep["positions"])
+        ep["actions"] = (ep["actions"] + [NO_ACTION] * n)[:n]
+        for key, (dtype, shape) in POSE_COLUMNS.items():
+            ep[key] = np.asarray(ep[key], dtype=dtype).reshape((n,) + shape)
+        self._episodes.append(ep)
+        self._current = None
+        if len(self._episodes) >= self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._episodes:
+            return
+        path = os.path.join(
+            self.output_dir,
+            f"trajectories_rank{self.rank}_{self._chunk_id:04d}.npz",
+        )
+        np.savez(path, **_to_columns(self._episodes))
+        self._chunk_id += 1
+        self._episodes = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+def _to_columns(episodes: List[Dict]) -> Dict[str, ndarray]:
+    lengths = [len(ep["positions"]) for ep in episodes]
+    ref_lengths = [len(ep["reference_path"]) for ep in episodes]
+    columns = {
+        "episode_id": np.array([ep["episode_id"] for ep in episodes]),
+        "scene_id": np.array([ep["scene_id"] for ep in episodes]),
+        "goal_position": np.stack([ep["goal_position"] for ep in episodes]),
+        "offsets": np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64),
+        "ref_offsets": np.concatenate([[0], np.cumsum(ref_lengths)]).astype(
+            np.int64
+        ),
+        "reference_path": np.concatenate(
+            [ep["reference_path"] for ep in episodes]
+        ),
+    }
+    for key in POSE_COLUMNS:
+        columns[key] = np.concatenate([ep[key] for ep in episodes])
+    return columns
+
+
+def load_trajectories(paths: Union[str, Sequence[str]]) -> Dict[str, ndarray]:
+    """Loads and concatenates trajectory chunks. `paths` may be a directory,
+    a glob pattern or a list of .npz files.
+    """
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            paths = os.path.join(paths, "trajectories_rank*_*.npz")
+        paths = sorted(glob.glob(paths))
+    chunks = []
+    for path in paths:
+        with np.load(path) as f:
+            chunks.append({k: f[k] for k in f.files})
+    if not chunks:
+        raise FileNotFoundError(f"no trajectory files found in {paths}")
+
+    merged = {}
+    for key in ("offsets", "ref_offsets"):
+        parts, base = [np.zeros(1, dtype=np.int64)], 0
+        for c in chunks:
+            parts.append(c[key][1:] + base)
+            base += c[key][-1]
+        merged[key] = np.concatenate(parts)
+    for key in chunks[0]:
+        if key not in merged:
+            merged[key] = np.concatenate([c[key] for c in chunks])
+    return merged
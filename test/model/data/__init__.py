@@ -87,14 +87,25 @@ def parse_sampling_rate(dataset_name):
     return 1.0
 
 
+def parse_mixture_weight(dataset_name):
+    match = re.search(r"@(\d+(\.\d+)?)$", dataset_name)
+    if match:
+        return float(match.group(1))
+    return None
+
+
 def data_list(dataset_names):
     config_list = []
     for dataset_name in dataset_names:
+        # "name%N@W": keep N% of the samples, mix with W times its size
+        mixture_weight = parse_mixture_weight(dataset_name)
+        dataset_name = re.sub(r"@(\d+(\.\d+)?)$", "", dataset_name)
         sampling_rate = parse_sampling_rate(dataset_name)
         dataset_name = re.sub(r"%(\d+)$", "", dataset_name)
         if dataset_name in data_dict.keys():
             config = data_dict[dataset_name].copy()
             config["sampling_rate"] = sampling_rate
+            config["mixture_weight"] = mixture_weight
             config["dataset_name"] = dataset_name
             config_list.append(config)
         else:
@@ -1,13 +1,16 @@
 import os
 import copy
 import json
+import mmap
 import random
 import logging
 import re
-import time
 import math
 import itertools
+import functools
 import ast
+import argparse
+import struct
 from dataclasses import dataclass, field
 from typing import Dict, Optional, Sequence, List, Tuple
 from io import BytesIO
@@ -17,18 +20,26 @@ from collections.abc import Sequence
 import numpy as np
 import torch
 from torch.utils.data import Dataset
-from PIL import Image
-from decord import VideoReader
+from PIL import Image, UnidentifiedImageError
+from decord import DECORDError, VideoReader
 import transformers
+from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
 
 from . import data_list
 from .rope2d import get_rope_index_25, get_rope_index_2
+from .shards import ShardedSupervisedDataset
+from .fetch import SampleQuarantine, SubstitutePool, TimedFetcher
+from .media_archive import FrameManifestCache, MediaArchive
 
 IGNORE_INDEX = -100
 IMAGE_TOKEN_INDEX = 151655
 VIDEO_TOKEN_INDEX = 151656
 DEFAULT_IMAGE_TOKEN = "<image>"
 DEFAULT_VIDEO_TOKEN = "<video>"
+# side length images are resized to by the VGGT loader
+VGGT_IMAGE_SIZE = 518
+# role header and end-of-turn tokens added by CHAT_TEMPLATE to every turn
+CHAT_TURN_OVERHEAD = 5
 
 local_rank = None
 
@@ -38,15 +49,237 @@ def rank0_print(*args):
         print(*args)
 
 
-def read_jsonl(path, max_samples: int=-1):
-    with open(path, "r") as f:
-        # return [json.loads(line) for line in f]
-        ret = []
+def vggt_decode_size(height, width):
+    """(height, width) to decode a frame at before the VGGT loader resizes
+    it to VGGT_IMAGE_SIZE wide; frames are never upscaled.
+    """
+    if width <= VGGT_IMAGE_SIZE:
+        return height, width
+    return max(1, round(height * VGGT_IMAGE_SIZE / width)), VGGT_IMAGE_SIZE
+
+
+# MP4/MOV boxes on the path from the file to a track's sample description
+MP4_CONTAINER_BOXES = {b"moov", b"trak", b"mdia", b"minf", b"stbl"}
+
+
+def _mp4_boxes(f, start, end):
+    f.seek(start)
+    while start + 8 <= end:
+        size, box_type = struct.unpack(">I4s", f.read(8))
+        body = start + 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            body += 8
+        elif size == 0:
+            size = end - start
+        if size < body - start:
+            return
+        yield box_type, body, start + size
+        start += size
+        f.seek(start)
+
+
+def _mp4_video_size(f, start, end):
+    for box_type, body, box_end in _mp4_boxes(f, start, end):
+        if box_type == b"hdlr":
+            # version/flags and pre_defined precede the handler type
+            f.seek(body + 8)
+            if f.read(4) != b"vide":
+                return None
+        elif box_type == b"stsd":
+            # width and height sit 32 bytes into the first visual sample entry
+            f.seek(body + 8 + 32)
+            width, height = struct.unpack(">HH", f.read(4))
+            return (height, width) if height and width else None
+        elif box_type in MP4_CONTAINER_BOXES:
+            size = _mp4_video_size(f, body, box_end)
+            if size is not None:
+                return size
+    return None
+
+
+def mp4_frame_size(f):
+    """(height, width) of the first video track of an MP4/MOV file object,
+    read from the track's sample description without decoding, or None.
+    """
+    end = f.seek(0, os.SEEK_END)
+    try:
+        return _mp4_video_size(f, 0, end)
+    except struct.error:
+        return None
+    finally:
+        f.seek(0)
+
+
+@functools.lru_cache(maxsize=65536)
+def frame_index_plan(total_frames, fps, interval, min_frames, max_frames):
+    """Indices of the frames sampled from a video of `total_frames` frames:
+    one every `interval` seconds, clamped to [min_frames, max_frames]. Many
+    samples share a frame count, so plans are memoised; the returned array
+    is read-only.
+    """
+    video_length = total_frames / fps
+    num_frames_to_sample = round(video_length / interval)
+    target_frames = min(max(num_frames_to_sample, min_frames), max_frames)
+    frame_idx = np.linspace(0, total_frames - 1, target_frames, dtype=int)
+    frame_idx = np.unique(frame_idx)
+    frame_idx.flags.writeable = False
+    return frame_idx
+
+
+def build_jsonl_offsets(path) -> np.ndarray:
+    """Byte offsets of the non-empty lines of a jsonl file, followed by the
+    file size. Cached as `<path>.offsets.npy` and rebuilt if the file is newer.
+    """
+    index_path = f"{path}.offsets.npy"
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        return np.load(index_path)
+    offsets = []
+    with open(path, "rb") as f:
+        offset = 0
         for line in f:
-            ret.append(json.loads(line))
-            if max_samples !=-1 and len(ret) >= max_samples:
-                break
-    return ret
+            if line.strip():
+                offsets.append(offset)
+            offset += len(line)
+    offsets.append(offset)
+    offsets = np.array(offsets, dtype=np.int64)
+    try:
+        tmp_path = f"{index_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, offsets)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Could not save jsonl index {index_path}: {e}")
+    return offsets
+
+
+class LazyJsonl:
+    """Read-only sequence over the records of a jsonl file. Only the byte
+    offset index is kept in memory; records are parsed from an mmap of the
+    file on access, so each access returns a fresh dict.
+    """
+
+    def __init__(self, path, max_samples: int=-1):
+        self.path = path
+        self.offsets = build_jsonl_offsets(path)
+        if max_samples != -1:
+            self.offsets = self.offsets[: max_samples + 1]
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, j):
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(self._mmap[self.offsets[j]:self.offsets[j + 1]])
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+    def __getstate__(self):
+        # the mmap is re-opened lazily in each dataloader worker
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+
+def load_annotations(path, max_samples: int=-1):
+    if path.split(".")[-1] == "jsonl":
+        return LazyJsonl(path, max_samples=max_samples)
+    return json.load(open(path, "r"))
+
+
+class AnnotationView:
+    """The training samples of all datasets, in training order, as a
+    sequence of annotation dicts. Sample i is line `sources[i, 1]` of
+    dataset `sources[i, 0]`; `data_path` and `tag` are filled in on access.
+    """
+
+    def __init__(self, dataset_list, annotations, sources: np.ndarray):
+        self.dataset_list = dataset_list
+        self.annotations = annotations
+        self.sources = sources
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __getitem__(self, i):
+        dataset_idx, line = self.sources[i]
+        data = self.dataset_list[dataset_idx]
+        ann = self.annotations[dataset_idx][line]
+        ann["data_path"] = data["data_path"]
+        ann["tag"] = data["tag"]
+        return ann
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+CHAT_TEMPLATE = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
+
+
+class ChatTemplateEncoder:
+    """Tokenizes single chat messages the way `apply_chat_template` does with
+    `CHAT_TEMPLATE`, but from cached pieces: the full system prefix and the
+    per-role `<|im_start|>{role}\n` header and `<|im_end|>\n` footer ids are
+    tokenized once, so only the message content is tokenized per sample.
+    The special tokens delimit the pieces, so the result is identical; content
+    starting with whitespace is tokenized together with its header because
+    the newline could merge with it. Construction checks the cached pieces
+    against the template and falls back to `apply_chat_template` otherwise.
+    """
+
+    def __init__(self, tokenizer: transformers.PreTrainedTokenizer, system_message: str):
+        self.tokenizer = tokenizer
+        self.template_tokenizer = copy.deepcopy(tokenizer)
+        self.template_tokenizer.chat_template = CHAT_TEMPLATE
+        self.system_ids = self.template_tokenizer.apply_chat_template(
+            [{"role": "system", "content": system_message}]
+        )
+        self.footer_ids = self._encode("<|im_end|>\n")
+        self._header_ids = {}
+        self.exact = True
+        self.exact = all(
+            self.encode_message(role, content) == self.template_tokenizer.apply_chat_template(
+                [{"role": role, "content": content}]
+            )
+            for role in ["user", "assistant"]
+            for content in ["Hello world.", " Hi\n<|image_pad|>\n"]
+        )
+
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def header_ids(self, role: str) -> List[int]:
+        if role not in self._header_ids:
+            self._header_ids[role] = self._encode(f"<|im_start|>{role}\n")
+        return self._header_ids[role]
+
+    def encode_message(self, role: str, content: str) -> List[int]:
+        if not self.exact:
+            return self.template_tokenizer.apply_chat_template(
+                [{"role": role, "content": content}]
+            )
+        if not content or content[0].isspace():
+            return self._encode(f"<|im_start|>{role}\n{content}") + self.footer_ids
+        return self.header_ids(role) + self._encode(content) + self.footer_ids
+
+
+_CHAT_ENCODERS: Dict[Tuple[int, str], ChatTemplateEncoder] = {}
+
+
+def get_chat_encoder(
+    tokenizer: transformers.PreTrainedTokenizer, system_message: str
+) -> ChatTemplateEncoder:
+    key = (id(tokenizer), system_message)
+    encoder = _CHAT_ENCODERS.get(key)
+    # the encoder holds a reference to the tokenizer, so its id stays valid
+    if encoder is None or encoder.tokenizer is not tokenizer:
+        encoder = _CHAT_ENCODERS[key] = ChatTemplateEncoder(tokenizer, system_message)
+    return encoder
 
 
 def preprocess_qwen_2_visual(
@@ -60,9 +293,7 @@ def preprocess_qwen_2_visual(
     if visual_type not in ["image", "video"]:
         raise ValueError("visual_type must be either 'image' or 'video'")
 
-    tokenizer = copy.deepcopy(tokenizer)
-    chat_template = "{% for message in messages %}{{'<|im_start|>' + message['role'] + '\n' + message['content'] + '<|im_end|>' + '\n'}}{% endfor %}{% if add_generation_prompt %}{{ '<|im_start|>assistant\n' }}{% endif %}"
-    tokenizer.chat_template = chat_template
+    encoder = get_chat_encoder(tokenizer, system_message)
 
     visual_replicate_index = 0
     input_ids, targets = [], []
@@ -76,9 +307,7 @@ def preprocess_qwen_2_visual(
 
         input_id, target = [], []
 
-        input_id += tokenizer.apply_chat_template(
-            [{"role": "system", "content": system_message}]
-        )
+        input_id += encoder.system_ids
         target += [IGNORE_INDEX] * len(input_id)
 
         for conv in source:
@@ -108,8 +337,7 @@ def preprocess_qwen_2_visual(
                     new_parts.append(parts[-1])
                     content = "".join(new_parts)
 
-            conv = [{"role": role, "content": content}]
-            encode_id = tokenizer.apply_chat_template(conv)
+            encode_id = encoder.encode_message(role, content)
             input_id += encode_id
             if role in ["user", "system"]:
                 target += [IGNORE_INDEX] * len(encode_id)
@@ -151,34 +379,76 @@ class LazySupervisedDataset(Dataset):
         else:
             self.get_rope_index = get_rope_index_2
 
-        list_data_dict = []
-
-        for data in dataset_list:
-            file_format = data["annotation_path"].split(".")[-1]
-            if file_format == "jsonl":
-                annotations = read_jsonl(data["annotation_path"], max_samples=data_args.max_samples)
-            else:
-                annotations = json.load(open(data["annotation_path"], "r"))
+        # subsampling and shuffling always follow data_args.data_seed, which
+        # falls back to the training seed (42 as in TrainingArguments), so
+        # every rank and every resumed run sees the same samples
+        data_seed = getattr(data_args, "data_seed", None)
+        if data_seed is None:
+            data_seed = getattr(data_args, "seed", 42)
+        rng = np.random.default_rng(data_seed)
+
+        annotations_list = []
+        # (dataset, line) of every sample; the samples themselves are only
+        # parsed when fetched
+        sample_sources = []
+
+        for dataset_idx, data in enumerate(dataset_list):
+            annotations = load_annotations(data["annotation_path"], data_args.max_samples)
+            lines = np.arange(len(annotations), dtype=np.int64)
             sampling_rate = data.get("sampling_rate", 1.0)
             if sampling_rate < 1.0:
-                annotations = random.sample(
-                    annotations, int(len(annotations) * sampling_rate)
-                )
-                print(f"sampling {len(annotations)} examples from dataset {data}")
+                lines = np.sort(rng.choice(
+                    len(annotations), int(len(annotations) * sampling_rate), replace=False
+                ))
+                print(f"sampling {len(lines)} examples from dataset {data}")
             else:
                 rank0_print(f"dataset name: {data}")
-            for ann in annotations:
-                ann["data_path"] = data["data_path"]
-                ann["tag"] = data["tag"]
-            list_data_dict += annotations
+            annotations_list.append(annotations)
+            sample_sources.append(
+                np.stack([np.full_like(lines, dataset_idx), lines], axis=1)
+            )
 
-        print(f"Total training samples: {len(list_data_dict)}")
+        sample_sources = np.concatenate(sample_sources, axis=0)
+        print(f"Total training samples: {len(sample_sources)}")
 
-        random.shuffle(list_data_dict)  # Randomly shuffle the data for training
+        # Randomly shuffle the data for training
+        order = rng.permutation(len(sample_sources))
+        sample_sources = sample_sources[order]
 
         print("Formatting inputs...Skip in lazy mode")
         self.tokenizer = tokenizer
-        self.list_data_dict = list_data_dict
+        self.dataset_list = dataset_list
+        self.sample_sources = sample_sources
+        self.list_data_dict = AnnotationView(dataset_list, annotations_list, sample_sources)
+        # kept with the run by default; "" keeps strikes in memory only and
+        # quarantine_strikes=0 never skips a sample
+        quarantine_path = getattr(data_args, "quarantine_path", None)
+        if quarantine_path is None and getattr(data_args, "output_dir", None):
+            quarantine_path = os.path.join(data_args.output_dir, "quarantine.jsonl")
+        self.quarantine = SampleQuarantine(
+            quarantine_path or None, getattr(data_args, "quarantine_strikes", 3)
+        )
+        if len(self.quarantine):
+            print(f"Skipping {len(self.quarantine)} quarantined samples")
+        self.annotation_stamps = [
+            "{0.st_size}-{0.st_mtime_ns}".format(os.stat(data["annotation_path"]))
+            for data in dataset_list
+        ]
+        self.fetcher = TimedFetcher(getattr(data_args, "fetch_timeout", 60.0))
+        pool_size = getattr(data_args, "substitute_pool_size", 8)
+        self.substitutes = {
+            tag: SubstitutePool(pool_size)
+            for tag in {data.get("tag", "2d") for data in dataset_list}
+        }
+        self._tag_indices = {}
+        media_archive = getattr(data_args, "media_archive", None)
+        self.media_archive = MediaArchive(media_archive) if media_archive else None
+        # kept with the run by default; "" keeps listings in memory only
+        frame_manifest_path = getattr(data_args, "frame_manifest_path", None)
+        if frame_manifest_path is None and getattr(data_args, "output_dir", None):
+            frame_manifest_path = os.path.join(data_args.output_dir, "frame_manifests.jsonl")
+        self.frame_manifests = FrameManifestCache(frame_manifest_path or None)
+        self._length_index = None
         self.data_args = data_args
         self.data_args.image_processor.max_pixels = data_args.max_pixels
         self.data_args.image_processor.min_pixels = data_args.min_pixels
@@ -188,44 +458,145 @@ class LazySupervisedDataset(Dataset):
     def __len__(self):
         return len(self.list_data_dict)
 
+    def estimate_visual_tokens(self, width: int, height: int) -> int:
+        """Number of visual tokens of one image of the given size, following
+        the VGGT load (width 518, centre crop), the crop to whole merged
+        patches and the image processor's resize in `process_images_unified_vggt`.
+        """
+        processor = self.data_args.image_processor
+        factor = processor.patch_size * processor.merge_size
+        height = min(round(height * VGGT_IMAGE_SIZE / width / 14) * 14, VGGT_IMAGE_SIZE)
+        width = VGGT_IMAGE_SIZE - VGGT_IMAGE_SIZE % factor
+        height = height - height % factor
+        height, width = smart_resize(
+            height, width, factor=factor,
+            min_pixels=processor.min_pixels, max_pixels=processor.max_pixels,
+        )
+        return height * width // factor**2
+
+    def sample_length(self, sample) -> int:
+        """Estimated sequence length (text plus visual tokens) of a raw
+        annotation, without decoding any media.
+        """
+        text_len = sum(
+            len(self.tokenizer(conv["value"]).input_ids) + CHAT_TURN_OVERHEAD
+            for conv in sample["conversations"]
+        )
+        image_files = sample.get("image", sample.get("images", []))
+        if isinstance(image_files, str):
+            image_files = [image_files]
+        visual_len = 0
+        for image_file in image_files:
+            try:
+                with Image.open(os.path.join(sample["data_path"], image_file)) as image:
+                    visual_len += self.estimate_visual_tokens(*image.size)
+            except (OSError, UnidentifiedImageError):
+                visual_len += self.estimate_visual_tokens(VGGT_IMAGE_SIZE, VGGT_IMAGE_SIZE)
+        if "video" in sample:
+            frames = getattr(self.data_args, "video_max_frames", 8)
+            visual_len += frames * self.estimate_visual_tokens(VGGT_IMAGE_SIZE, VGGT_IMAGE_SIZE)
+        return text_len + visual_len
+
+    def length_index_path(self, data) -> str:
+        processor = self.data_args.image_processor
+        # the annotation file's size and mtime make edited files miss the cache
+        stat = os.stat(data["annotation_path"])
+        key = "_".join(
+            str(v) for v in (
+                processor.patch_size, processor.merge_size, processor.min_pixels,
+                processor.max_pixels, getattr(self.data_args, "video_max_frames", 8),
+                len(self.tokenizer), stat.st_size, stat.st_mtime_ns,
+            )
+        )
+        return f"{data['annotation_path']}.lengths_{key}.npy"
+
+    def build_lengths(self, data) -> np.ndarray:
+        print(f"Building length index for {data['annotation_path']}")
+        annotations = load_annotations(data["annotation_path"])
+        return np.array(
+            [
+                self.sample_length(dict(ann, data_path=data["data_path"]))
+                for ann in annotations
+            ],
+            dtype=np.int32,
+        )
+
+    def write_length_index(self, rank: int = 0, world_size: int = 1) -> None:
+        """Computes and stores the length index of every annotation file
+        that does not have one yet. Run offline, before training (see the
+        `__main__` block of this module); processes given `rank` and
+        `world_size` split the files between them.
+        """
+        for d in range(rank, len(self.dataset_list), world_size):
+            data = self.dataset_list[d]
+            path = self.length_index_path(data)
+            if os.path.exists(path):
+                continue
+            lengths = self.build_lengths(data)
+            tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+            try:
+                np.save(tmp_path, lengths)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    @property
+    def length_index(self) -> np.ndarray:
+        """Per-sample token lengths, read from the files stored next to each
+        annotation file by `write_length_index`.
+        """
+        if self._length_index is not None:
+            return self._length_index
+        per_dataset = []
+        for data in self.dataset_list:
+            path = self.length_index_path(data)
+            if not os.path.exists(path):
+                raise FileNotFoundError(
+                    f"No length index for {data['annotation_path']} with these data "
+                    f"arguments; build it with `python -m model.data.data_qwen` first"
+                )
+            per_dataset.append(np.load(path))
+        offsets = np.concatenate([[0], np.cumsum([len(lengths) for lengths in per_dataset])])
+        self._length_index = np.concatenate(per_dataset)[
+            offsets[self.sample_sources[:, 0]] + self.sample_sources[:, 1]
+        ].astype(np.int32)
+        return self._length_index
+
     @property
     def lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(
-                len(conv["value"].split()) for conv in sample["conversations"]
-            )
-            if "image" in sample:
-                image_num = len(sample["image"])
-            elif "images" in sample:
-                image_num = len(sample["images"])
-            elif "video" in sample:
-                image_num = getattr(self.data_args, "video_max_frames", 8)
-            else:
-                image_num = 0
-            length_list.append(image_num * 252 + cur_len)
-        return length_list
+        return self.length_index.tolist()
 
     @property
     def modality_lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(
-                len(conv["value"].split()) for conv in sample["conversations"]
-            )
-            if "image" in sample:
-                image_num = len(sample["image"])
-            elif "images" in sample:
-                image_num = len(sample["images"])
-            elif "video" in sample:
-                image_num = getattr(self.data_args, "video_max_frames", 8)
-            else:
-                image_num = 0
-            cur_len += image_num*252
-            tag = sample.get("tag", "2d")
-            cur_len = -cur_len if tag == "2d" else cur_len
-            length_list.append(cur_len)
-        return length_list
+        # 2d samples are marked with negative lengths
+        return (self.length_index * np.where(self.sample_tags == "2d", -1, 1)).tolist()
+
+    def dataset_groups(self) -> Dict[str, np.ndarray]:
+        """Dataset name -> indices of its samples, for MixtureSampler."""
+        names = [data["dataset_name"] for data in self.dataset_list]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"datasets listed more than once in dataset_use: {duplicates}")
+        return {
+            data["dataset_name"]: np.nonzero(self.sample_sources[:, 0] == dataset_idx)[0]
+            for dataset_idx, data in enumerate(self.dataset_list)
+        }
+
+    def mixture_weights(self) -> Dict[str, float]:
+        """Weights given as `name@W` in dataset_use, multipliers on each
+        dataset's size (unset ones are omitted and default to 1.0).
+        """
+        return {
+            data["dataset_name"]: data["mixture_weight"]
+            for data in self.dataset_list
+            if data.get("mixture_weight") is not None
+        }
+
+    @property
+    def sample_tags(self) -> np.ndarray:
+        tags = np.array([data.get("tag", "2d") for data in self.dataset_list])
+        return tags[self.sample_sources[:, 0]]
 
     @property
     def pre_calculated_length(self):
@@ -233,12 +604,13 @@ class LazySupervisedDataset(Dataset):
             length_list = [sample["num_tokens"] for sample in self.list_data_dict]
             return np.array(length_list)
         else:
-            print("No pre-calculated length available.")
-            return np.array([1] * len(self.list_data_dict))
+            print("No pre-calculated length available, using the length index.")
+            return self.length_index
 
     def process_image_unified(self, image_file):
-        processor = copy.deepcopy(self.data_args.image_processor)
-        image = Image.open(image_file).convert("RGB")
+        # the processor is only read here, so it is shared instead of copied
+        processor = self.data_args.image_processor
+        image = Image.open(self.media_file(image_file)).convert("RGB")
 
         visual_processed = processor.preprocess(image, return_tensors="pt")
         image_tensor = visual_processed["pixel_values"]
@@ -263,57 +635,102 @@ class LazySupervisedDataset(Dataset):
 
     def process_image_unified_vggt(self, image_file):
         # this function reshapes the image to the width size of 518
-        image_processor = copy.deepcopy(self.data_args.image_processor)
+        ret = self.process_images_unified_vggt([image_file])
+        return {
+            "pixel_values": ret["pixel_values"][0],
+            "image_grid_thw": ret["image_grid_thw"][0],
+            "images_vggt": ret["images_vggt"][0],
+        }
+
+    def process_images_unified_vggt(self, image_files):
+        """Multi-view version of `process_image_unified_vggt`. Each view is
+        loaded and cropped as before, then all views of the same cropped size
+        go through a single resize/normalize/patchify call of the shared image
+        processor. Returns per-view lists of `pixel_values`, `image_grid_thw`
+        and `images_vggt`, in the order of `image_files`.
+        """
+        image_processor = self.data_args.image_processor
         from qwen_vl.model.vggt.utils.load_fn import load_and_preprocess_images
-        images = load_and_preprocess_images([image_file])
-        images_vggt = copy.deepcopy(images[0])
         merge_size: int = getattr(image_processor, "merge_size")
         patch_size: int = getattr(image_processor, "patch_size")
-        _, height, width = images[0].shape
-        # merge_size = 2
-        if (width // patch_size) % merge_size > 0:
-            width = width - (width // patch_size) % merge_size * patch_size
-        if (height // patch_size) % merge_size > 0:
-            height = height - (height // patch_size) % merge_size * patch_size
-        images = images[:,:, :height, :width]
-        visual_processed = image_processor(images, return_tensors="pt", do_rescale=False)
-        image_tensor = visual_processed["pixel_values"]
-        if isinstance(image_tensor, List):
-            image_tensor = image_tensor[0]
-        grid_thw = visual_processed["image_grid_thw"][0]
-        # return image_tensor, grid_thw
+
+        images_vggt, cropped = [], []
+        for image_file in image_files:
+            images = load_and_preprocess_images([image_file])
+            images_vggt.append(images[0].clone())
+            _, height, width = images[0].shape
+            if (width // patch_size) % merge_size > 0:
+                width = width - (width // patch_size) % merge_size * patch_size
+            if (height // patch_size) % merge_size > 0:
+                height = height - (height // patch_size) % merge_size * patch_size
+            cropped.append(images[0, :, :height, :width])
+
+        groups = {}
+        for idx, image in enumerate(cropped):
+            groups.setdefault(tuple(image.shape), []).append(idx)
+
+        pixel_values = [None] * len(cropped)
+        grid_thw = [None] * len(cropped)
+        for indices in groups.values():
+            visual_processed = image_processor(
+                torch.stack([cropped[idx] for idx in indices]),
+                return_tensors="pt",
+                do_rescale=False,
+            )
+            grids = visual_processed["image_grid_thw"]
+            patches = visual_processed["pixel_values"]
+            if isinstance(patches, List):
+                patches = torch.cat(patches, dim=0)
+            patches = torch.split(patches, grids.prod(dim=-1).tolist(), dim=0)
+            for j, idx in enumerate(indices):
+                pixel_values[idx] = patches[j]
+                grid_thw[idx] = grids[j]
         return {
-            "pixel_values": image_tensor,
+            "pixel_values": pixel_values,
             "image_grid_thw": grid_thw,
-            "images_vggt": images_vggt
+            "images_vggt": images_vggt,
         }
 
+    @property
+    def video_processor(self):
+        """Copy of the image processor with the per-frame video pixel limits,
+        created once instead of for every video.
+        """
+        if getattr(self, "_video_processor", None) is None:
+            processor = copy.deepcopy(self.data_args.image_processor)
+            processor.max_pixels = self.data_args.video_max_frame_pixels
+            processor.min_pixels = self.data_args.video_min_frame_pixels
+            processor.size["longest_edge"] = processor.max_pixels
+            processor.size["shortest_edge"] = processor.min_pixels
+            self._video_processor = processor
+        return self._video_processor
+
     def process_video(self, video_file):
         if not os.path.exists(video_file):
             print(f"File not exist: {video_file}")
-        vr = VideoReader(video_file, num_threads=4)
+        processor = self.video_processor
+        factor = processor.patch_size * processor.merge_size
+        # decode straight at the size the processor would resize frames to
+        vr = self.video_reader(
+            video_file,
+            lambda height, width: smart_resize(
+                height, width, factor=factor,
+                min_pixels=processor.min_pixels, max_pixels=processor.max_pixels,
+            ),
+        )
         total_frames = len(vr)
         avg_fps = vr.get_avg_fps()
         video_length = total_frames / avg_fps
-        interval = getattr(self.data_args, "base_interval", 4)
-
-        num_frames_to_sample = round(video_length / interval)
-        video_min_frames = getattr(self.data_args, "video_min_frames", 4)
-        video_max_frames = getattr(self.data_args, "video_max_frames", 8)
-
-        target_frames = min(
-            max(num_frames_to_sample, video_min_frames), video_max_frames
+        frame_idx = frame_index_plan(
+            total_frames,
+            avg_fps,
+            getattr(self.data_args, "base_interval", 4),
+            getattr(self.data_args, "video_min_frames", 4),
+            getattr(self.data_args, "video_max_frames", 8),
         )
-        frame_idx = np.linspace(0, total_frames - 1, target_frames, dtype=int)
-        frame_idx = np.unique(frame_idx)
         video = vr.get_batch(frame_idx).asnumpy()
         fps = len(frame_idx) / video_length
-        processor = copy.deepcopy(self.data_args.image_processor)
-        processor.max_pixels = self.data_args.video_max_frame_pixels
-        processor.min_pixels = self.data_args.video_min_frame_pixels
-        processor.size["longest_edge"] = processor.max_pixels
-        processor.size["shortest_edge"] = processor.min_pixels
-        video_processed = processor.preprocess(
+        video_processed = self.video_processor.preprocess(
             images=None, videos=video, return_tensors="pt"
         )
         video_tensor = video_processed["pixel_values_videos"]
@@ -324,81 +741,188 @@ class LazySupervisedDataset(Dataset):
         return video_tensor, grid_thw, second_per_grid_ts
     
 
-    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        num_base_retries = 3
-        num_final_retries = 30
+    def media_paths(self, i) -> List[str]:
+        """Files sample i reads, for read-ahead (see fetch.ReadAheadSampler)."""
+        sample = self.list_data_dict[i]
+        files = sample.get("image", sample.get("images", []))
+        if isinstance(files, str):
+            files = [files]
+        paths = [os.path.join(sample["data_path"], f) for f in files]
+        if "video" in sample:
+            video_file = os.path.join(sample["data_path"], sample["video"])
+            if self.is_frame_dir(video_file):
+                paths += self.sampled_frame_files(video_file)
+            else:
+                paths.append(video_file)
+        if self.media_archive is not None:
+            paths = [path for path in paths if path not in self.media_archive]
+        return paths
+
+    def archive_paths(self, i) -> List[str]:
+        """Media files and frame directories of sample i, for pack_media_archive."""
+        sample = self.list_data_dict[i]
+        files = sample.get("image", sample.get("images", []))
+        if isinstance(files, str):
+            files = [files]
+        if "video" in sample:
+            files = files + [sample["video"]]
+        return [os.path.join(sample["data_path"], f) for f in files]
+
+    def media_file(self, path):
+        """`path`, or its bytes as a file object if they are archived."""
+        if self.media_archive is not None and path in self.media_archive:
+            return BytesIO(self.media_archive.read(path))
+        return path
+
+    def sample_key(self, i) -> str:
+        """Identifies sample i across runs: dataset name, annotation file
+        size and mtime, and annotation line.
+        """
+        dataset_idx, line = self.sample_sources[i]
+        data = self.dataset_list[dataset_idx]
+        return f"{data['dataset_name']}@{self.annotation_stamps[dataset_idx]}:{line}"
+
+    def sample_tag(self, i) -> str:
+        return self.dataset_list[self.sample_sources[i][0]].get("tag", "2d")
+
+    def tag_indices(self, tag) -> np.ndarray:
+        if tag not in self._tag_indices:
+            self._tag_indices[tag] = np.nonzero(self.sample_tags == tag)[0]
+        return self._tag_indices[tag]
+
+    def record_failure(self, i, key, e) -> None:
+        # only unreadable media count towards quarantine; timeouts may be
+        # transient and other exceptions are bugs, not bad samples
+        if isinstance(e, (OSError, DECORDError)) and not isinstance(e, TimeoutError):
+            print(f"Failed to load sample {i} ({key}), strike recorded. Exception:", e)
+            self.quarantine.strike(key, repr(e))
+        else:
+            print(f"Failed to fetch sample {i} ({key}). Exception:", e)
 
-        # try the current sample first
-        for attempt_idx in range(num_base_retries):
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        # a failing or slow sample is replaced at once by a recently loaded
+        # one of the same tag; it is never waited on or retried
+        key = self.sample_key(i)
+        tag = self.sample_tag(i)
+        substitutes = self.substitutes[tag]
+        if key not in self.quarantine:
             try:
-                sample = self._get_item(i)
+                sample = self.fetcher(self._get_item, i)
+                substitutes.add(sample)
                 return sample
             except Exception as e:
-                # sleep 1s in case it is a cloud disk issue
-                print(f"[Try #{attempt_idx}] Failed to fetch sample {i}. Exception:", e)
-                time.sleep(1)
+                self.record_failure(i, key, e)
 
-        # try other samples, in case it is file corruption issue
-        for attempt_idx in range(num_base_retries):
+        sample = substitutes.take()
+        if sample is not None:
+            return sample
+
+        # nothing of this tag loaded yet in this worker: try other samples
+        # of the same tag, without sleeping
+        candidates = self.tag_indices(tag)
+        num_other_tries = 10
+        for attempt_idx in range(num_other_tries):
+            other = int(random.choice(candidates))
+            other_key = self.sample_key(other)
+            if other_key in self.quarantine:
+                continue
             try:
-                next_index = min(i + 1, len(self.list_data_dict) - 1)
-                # sample_idx = random.choice(range(len(self)))
-                sample = self._get_item(next_index)
+                sample = self.fetcher(self._get_item, other)
+                substitutes.add(sample)
                 return sample
             except Exception as e:
-                # no need to sleep
-                print(
-                    f"[Try other #{attempt_idx}] Failed to fetch sample {next_index}. Exception:",
-                    e,
-                )
-                pass
-
-        try:
-            sample = self._get_item(i)
-            return sample
-        except Exception as e:
-            raise e
+                print(f"[Try other #{attempt_idx}]", end=" ")
+                self.record_failure(other, other_key, e)
+        raise RuntimeError(f"Could not fetch sample {i} or any substitute")
     
+    def get_frame_indices(self, total_frames, fps=1):
+        return frame_index_plan(
+            total_frames,
+            fps,
+            getattr(self.data_args, "base_interval", 2),
+            getattr(self.data_args, "video_min_frames", 4),
+            getattr(self.data_args, "video_max_frames", 8),
+        )
+
+    def is_frame_dir(self, video_file) -> bool:
+        if self.media_archive is not None and self.media_archive.isdir(video_file):
+            return True
+        if video_file in self.frame_manifests:
+            return True
+        return os.path.isdir(video_file)
+
+    def sampled_frame_files(self, video_dir) -> List[str]:
+        """Paths of the frames read from a directory of frame images."""
+        if self.media_archive is not None and self.media_archive.isdir(video_dir):
+            frame_files = [os.path.join(video_dir, f) for f in self.media_archive.listdir(video_dir)]
+        else:
+            frame_files = [os.path.join(video_dir, f) for f in self.frame_manifests.listdir(video_dir)]
+        frame_idx = self.get_frame_indices(len(frame_files), 1)
+        return [frame_files[i] for i in frame_idx]
+
+    def video_reader(self, video_file, decode_size=None):
+        """VideoReader that decodes frames at `decode_size(height, width)`
+        instead of the native resolution, so full-size frames are never
+        materialised. The native size comes from the MP4/MOV headers; other
+        containers are decoded at their native size.
+        """
+        source = self.media_file(video_file)
+        size = None
+        if decode_size is not None:
+            if isinstance(source, BytesIO):
+                size = mp4_frame_size(source)
+            else:
+                with open(source, "rb") as f:
+                    size = mp4_frame_size(f)
+        if size is None or decode_size(*size) == size:
+            return VideoReader(source, num_threads=4)
+        target_height, target_width = decode_size(*size)
+        return VideoReader(source, width=target_width, height=target_height, num_threads=4)
+
+    def open_frame(self, frame_file, reduced=True):
+        """Opens a frame image; JPEGs wider than VGGT_IMAGE_SIZE are decoded
+        at a reduced DCT scale (PIL draft mode) no smaller than needed.
+        """
+        image = Image.open(self.media_file(frame_file))
+        if reduced and image.format == "JPEG" and image.width > VGGT_IMAGE_SIZE:
+            image.draft("RGB", vggt_decode_size(image.height, image.width)[::-1])
+        return image.convert("RGB")
+
     def read_video_images(self, source):
         # read video images from the source
         assert isinstance(source["video"], str), "video should be a string"
         video_file = os.path.join(source["data_path"], source["video"])
-        if not os.path.exists(video_file):
+        known = video_file in self.frame_manifests or (
+            self.media_archive is not None
+            and (video_file in self.media_archive or self.media_archive.isdir(video_file))
+        )
+        if not known and not os.path.exists(video_file):
             print(f"File not exist: {video_file}")
             raise FileNotFoundError
-        
-        def get_frame_indices(total_frames, fps=1):
-            video_length = total_frames / fps
-            interval = getattr(self.data_args, "base_interval", 2)
-            num_frames_to_sample = round(video_length / interval)
-            video_min_frames = getattr(self.data_args, "video_min_frames", 4)
-            video_max_frames = getattr(self.data_args, "video_max_frames", 8)
-            target_frames = min(
-                max(num_frames_to_sample, video_min_frames), video_max_frames
-            )
-            frame_idx = np.linspace(0, total_frames - 1, target_frames, dtype=int)
-            frame_idx = np.unique(frame_idx)
-            return frame_idx        
+
+        # frames are resized to VGGT_IMAGE_SIZE wide later, so they can be
+        # decoded at about that size, unless visual marks are drawn on them
+        # in original pixel coordinates
+        reduced = source.get("spar_info", None) is None
 
         # check whether video_file is a directory
-        if os.path.isdir(video_file):
-            frame_files = [os.path.join(video_file, f) for f in os.listdir(video_file) if os.path.isfile(os.path.join(video_file, f))]
-            frame_files.sort()
-            frame_idx = get_frame_indices(len(frame_files), 1)
-            images = [frame_files[i] for i in frame_idx]
-            images = [Image.open(frame).convert("RGB") for frame in images]
+        if self.is_frame_dir(video_file):
+            images = self.sampled_frame_files(video_file)
+            images = [self.open_frame(frame, reduced) for frame in images]
         elif any([video_file.endswith(ext) for ext in [".mp4", ".avi", ".mov"]]):
-            vr = VideoReader(video_file, num_threads=4)
+            vr = self.video_reader(video_file, vggt_decode_size if reduced else None)
             total_frames = len(vr)
             avg_fps = vr.get_avg_fps()
-            frame_idx = get_frame_indices(total_frames, avg_fps)
+            frame_idx = self.get_frame_indices(total_frames, avg_fps)
             video = vr.get_batch(frame_idx).asnumpy()
             
             images = [Image.fromarray(frame).convert("RGB") for frame in video]
         return images
 
     def _get_item(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        # fetched once: lazily loaded samples are parsed anew on every access
+        sample = self.list_data_dict[i]
+        sources = sample
         if isinstance(i, int):
             sources = [sources]
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
@@ -423,15 +947,15 @@ class LazySupervisedDataset(Dataset):
 
         # notice that we use images as the tag
         if "image" in sources[0]:
-            image_folder = self.list_data_dict[i]["data_path"]
-            image_file = self.list_data_dict[i]["image"]
+            image_folder = sample["data_path"]
+            image_file = sample["image"]
             if isinstance(image_file, List):
                 if len(image_file) > 1:
                     if isinstance(image_file[0], str):
                         image_file = [
                             os.path.join(image_folder, file) for file in image_file
                         ]
-                        image_file = [Image.open(img).convert("RGB") for img in image_file]
+                        image_file = [Image.open(self.media_file(img)).convert("RGB") for img in image_file]
                     elif isinstance(image_file[0], Image.Image):
                         pass
                     else:
@@ -442,7 +966,6 @@ class LazySupervisedDataset(Dataset):
                     # results = [self.process_image_unified(file) for file in image_file]
                     # results = [self.process_image_unified_vggt(file) for file in image_file]
                     # image, grid_thw = zip(*results)
-                    image, grid_thw, images_vggt = [], [], []
                     # for i ,file in enumerate(image_file):
                     #     if i == len(image_file) -1:
                     #         ret = self.process_image_unified_vggt(file,True)
@@ -453,17 +976,15 @@ class LazySupervisedDataset(Dataset):
                     #     images_vggt.append(ret["images_vggt"])
                     #     grid_thw.append(ret["image_grid_thw"])
 
-                    for file in image_file:
-
-                        ret = self.process_image_unified_vggt(file)
-                        image.append(ret["pixel_values"])
-                        images_vggt.append(ret["images_vggt"])
-                        grid_thw.append(ret["image_grid_thw"])
+                    ret = self.process_images_unified_vggt(image_file)
+                    image = ret["pixel_values"]
+                    images_vggt = ret["images_vggt"]
+                    grid_thw = ret["image_grid_thw"]
                 else:
                     image_file = image_file[0]
                     if isinstance(image_file, str):
                         image_file = os.path.join(image_folder, image_file)
-                        image_file = Image.open(image_file).convert("RGB")
+                        image_file = Image.open(self.media_file(image_file)).convert("RGB")
                     elif isinstance(image_file, Image.Image):
                         pass
                     else:
@@ -498,8 +1019,8 @@ class LazySupervisedDataset(Dataset):
                 torch.stack(grid_thw, dim=0),
             )
         elif "video" in sources[0]:
-            video_file = self.list_data_dict[i]["video"]
-            video_folder = self.list_data_dict[i]["data_path"]
+            video_file = sample["video"]
+            video_folder = sample["data_path"]
             if isinstance(video_file, List):
                 if len(video_file) > 1:
                     video_file = [
@@ -554,16 +1075,16 @@ class LazySupervisedDataset(Dataset):
                 position_ids=position_ids,
             )
 
-        if "image" in self.list_data_dict[i]:
+        if "image" in sample:
             data_dict["pixel_values"] = image
             data_dict["image_grid_thw"] = grid_thw
             data_dict["images_vggt"] = images_vggt
         # video exist in the data
-        elif "video" in self.list_data_dict[i]:
+        elif "video" in sample:
             data_dict["pixel_values_videos"] = video
             data_dict["video_grid_thw"] = grid_thw
         
-        data_dict["tag"] = self.list_data_dict[i].get("tag", "2d")
+        data_dict["tag"] = sample.get("tag", "2d")
         return data_dict
 
 
@@ -662,14 +1183,18 @@ class DataCollatorForSupervisedDataset(object):
         batch["pixel_values_videos"] = concat_videos
         batch["video_grid_thw"] = video_grid_thw
         batch["position_ids"] = position_ids
-                
-        # assume all data in a batch has images_vggt
+        self.add_images_vggt(batch, instances)
+        return batch
+
+    @staticmethod
+    def add_images_vggt(batch: Dict, instances: Sequence[Dict]) -> None:
+        # assume all data in a batch has images_vggt; one entry per sample, in
+        # the order of the samples (of the packed segments when flattened)
         if "images_vggt" in instances[0]:
             images_vggt = [torch.stack(instance["images_vggt"]) for instance in instances]
             batch["images_vggt"] = images_vggt
             assert len(set([instance["tag"] for instance in instances])) == 1, "all data in a batch should have the same tag"
             batch["tag"] = instances[0]["tag"]
-        return batch
 
 
 @dataclass
@@ -752,12 +1277,7 @@ class FlattenedDataCollatorForSupervisedDataset(DataCollatorForSupervisedDataset
         batch["image_grid_thw"] = grid_thw
         batch["pixel_values_videos"] = concat_videos
         batch["video_grid_thw"] = video_grid_thw
-
-                
-        # assume all data in a batch has images_vggt
-        if "images_vggt" in instances[0]:
-            raise NotImplementedError("FlattenedDataCollatorForSupervisedDataset does not support images_vggt")
-
+        self.add_images_vggt(batch, instances)
         return batch
 
 
@@ -765,7 +1285,11 @@ def make_supervised_data_module(
     tokenizer: transformers.PreTrainedTokenizer, data_args
 ) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
-    train_dataset = LazySupervisedDataset(tokenizer=tokenizer, data_args=data_args)
+    if getattr(data_args, "shard_dir", None):
+        # samples were compiled offline with shards.compile_shards
+        train_dataset = ShardedSupervisedDataset(data_args.shard_dir)
+    else:
+        train_dataset = LazySupervisedDataset(tokenizer=tokenizer, data_args=data_args)
     if data_args.data_flatten:
         data_collator = FlattenedDataCollatorForSupervisedDataset(tokenizer=tokenizer)
         return dict(
@@ -777,5 +1301,45 @@ def make_supervised_data_module(
     )
 
 
+def add_data_args(parser) -> None:
+    """Options describing the training data, for the offline tools that
+    build a LazySupervisedDataset (length index, shards). They must match
+    the arguments of the training run.
+    """
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--dataset_use", type=str, required=True)
+    parser.add_argument("--model_type", type=str, default="qwen2.5vl")
+    parser.add_argument("--max_samples", type=int, default=-1)
+    parser.add_argument("--max_pixels", type=int, default=28 * 28 * 576)
+    parser.add_argument("--min_pixels", type=int, default=28 * 28 * 16)
+    parser.add_argument("--video_max_frames", type=int, default=8)
+    parser.add_argument("--video_min_frames", type=int, default=4)
+    parser.add_argument("--video_max_frame_pixels", type=int, default=32 * 28 * 28)
+    parser.add_argument("--video_min_frame_pixels", type=int, default=4 * 28 * 28)
+    parser.add_argument("--data_seed", type=int, default=None)
+    parser.add_argument("--media_archive", type=str, default=None)
+
+
+def dataset_from_args(args) -> "LazySupervisedDataset":
+    """LazySupervisedDataset for the options added by `add_data_args`."""
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.model_name_or_path, padding_side="right", use_fast=False
+    )
+    data_args = argparse.Namespace(**vars(args))
+    data_args.image_processor = transformers.AutoProcessor.from_pretrained(
+        args.model_name_or_path
+    ).image_processor
+    data_args.data_flatten = False
+    return LazySupervisedDataset(tokenizer=tokenizer, data_args=data_args)
+
+
 if __name__ == "__main__":
-    pass
+    parser = argparse.ArgumentParser(
+        description="Build the length index of the annotation files in --dataset_use."
+    )
+    add_data_args(parser)
+    parser.add_argument("--rank", type=int, default=0)
+    parser.add_argument("--world_size", type=int, default=1)
+    args = parser.parse_args()
+    dataset = dataset_from_args(args)
+    dataset.write_length_index(args.rank, args.world_size)
@@ -0,0 +1,271 @@
+import os
+import json
+import logging
+import time
+import random
+import socket
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+def append_line(path: str, line: str) -> None:
+    """Appends `line` to the file shared by all workers and ranks at `path`."""
+    # a single O_APPEND write keeps lines from concurrent writers intact
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+class SampleQuarantine:
+    """Load failures of samples, persisted as one json line per failure.
+    A sample is skipped once it has failed `strikes` times. Every
+    dataloader worker (and rank) appends to the same file and picks up the
+    others' entries when the file grows, so a bad sample is only paid for a
+    few times and stays skipped in later epochs and runs. Without a `path`
+    (or if it cannot be written) failures are only counted in memory.
+    """
+
+    def __init__(self, path: Optional[str], strikes: int = 3, refresh_interval: float = 5.0):
+        self.path = path
+        self.strikes = strikes
+        self.refresh_interval = refresh_interval
+        self.counts: Dict[str, int] = {}
+        self._token = uuid.uuid4().hex[:8]
+        self._read_size = 0
+        self._last_refresh = 0.0
+        self.refresh(force=True)
+
+    def _writer(self) -> str:
+        # forked dataloader workers share the token but not the pid
+        return f"{socket.gethostname()}:{os.getpid()}:{self._token}"
+
+    def refresh(self, force: bool = False) -> None:
+        if self.path is None or not os.path.exists(self.path):
+            return
+        now = time.monotonic()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+        if os.path.getsize(self.path) == self._read_size:
+            return
+        with open(self.path, "r") as f:
+            f.seek(self._read_size)
+            chunk = f.read()
+        # a partially written last line is read again next time
+        complete = chunk[: chunk.rfind("\n") + 1]
+        self._read_size += len(complete.encode("utf-8"))
+        writer = self._writer()
+        for line in complete.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            # this process's own strikes are already counted
+            if entry.get("writer") != writer:
+                self.counts[entry["key"]] = self.counts.get(entry["key"], 0) + 1
+
+    def __contains__(self, key: str) -> bool:
+        if self.strikes <= 0:
+            return False
+        self.refresh()
+        return self.counts.get(key, 0) >= self.strikes
+
+    def strike(self, key: str, reason: str) -> None:
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self.path is None:
+            return
+        line = json.dumps(
+            {"key": key, "reason": reason, "time": time.time(), "writer": self._writer()}
+        ) + "\n"
+        try:
+            append_line(self.path, line)
+        except OSError as e:
+            print(f"Could not record quarantine strike in {self.path}: {e}")
+
+    def __len__(self) -> int:
+        return sum(count >= self.strikes for count in self.counts.values())
+
+
+class TimedFetcher:
+    """Runs sample loads on a helper thread and gives up after `timeout`
+    seconds. A load that hangs (e.g. on a stalled network read) cannot be
+    killed, so its thread is abandoned and a fresh one is used for the next
+    load.
+    """
+
+    def __init__(self, timeout: Optional[float]):
+        self.timeout = timeout
+        self._executor = None
+        self._executor_pid = None
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # a forked dataloader worker inherits the executor but not its
+        # thread, so every process builds its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def __call__(self, fn: Callable, *args):
+        if not self.timeout:
+            return fn(*args)
+        future = self._pool().submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise FetchTimeout(f"load did not finish within {self.timeout}s")
+
+    def __getstate__(self):
+        # threads do not survive pickling into dataloader workers
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+
+class SubstitutePool:
+    """Ring of recently loaded samples. When a sample cannot be loaded, one
+    of these is returned at once instead of waiting on another load.
+    """
+
+    def __init__(self, size: int = 8):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, sample) -> None:
+        with self._lock:
+            self.samples.append(sample)
+
+    def take(self):
+        with self._lock:
+            if not self.samples:
+                return None
+            return random.choice(self.samples)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["samples"] = deque(maxlen=self.samples.maxlen)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class MediaPrefetcher:
+    """Pulls media files into the OS page cache on a thread pool ahead of
+    use, so that decoding, in whichever process shares that cache (e.g. the
+    dataloader workers), reads from RAM and file latency overlaps with
+    compute. Nothing is kept in the prefetcher itself: files are hinted
+    with posix_fadvise(WILLNEED), or read through a reused buffer where
+    that is not available.
+    """
+
+    def __init__(self, num_threads: int = 16):
+        self.num_threads = num_threads
+        self._executor = None
+        self._executor_pid = None
+        self._local = threading.local()
+
+    def _warm(self, path: str) -> None:
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                return
+            buf = getattr(self._local, "buf", None)
+            if buf is None:
+                buf = self._local.buf = bytearray(1 << 20)
+            while f.readinto(buf):
+                pass
+
+    def _run(self, media_paths: Callable, index) -> None:
+        try:
+            paths = media_paths(index)
+        except Exception as e:
+            logger.warning(f"Could not list media of sample {index} for read-ahead: {e}")
+            return
+        for path in paths:
+            try:
+                self._warm(path)
+            except OSError as e:
+                logger.warning(f"Could not read ahead {path}: {e}")
+
+    def prefetch(self, media_paths: Callable, index) -> None:
+        """Warms the files `media_paths(index)` lists; both run on the pool."""
+        if self._executor is None or self._executor_pid != os.getpid():
+            # after a fork the threads are gone
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._executor_pid = os.getpid()
+        self._executor.submit(self._run, media_paths, index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        state["_executor"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+
+class ReadAheadSampler:
+    """Wraps a sampler or batch sampler and, while it is iterated, reads the
+    media files of the samples `lookahead` positions ahead on
+    `num_threads` threads, so they are in the OS page cache when the
+    dataloader workers decode them. `media_paths(index)` lists the files of
+    one sample (LazySupervisedDataset.media_paths); it is called on the
+    read-ahead threads, not while iterating.
+
+    The wrapped sampler runs `lookahead` items ahead of what this sampler
+    has yielded (`pending` of them at any time), so a position it records
+    for resuming, such as DeterministicDistributedSampler.consumed_samples,
+    includes them. Subtract `pending` (times the batch size and number of
+    replicas, as applicable) or pass the trained sample count when saving.
+    """
+
+    def __init__(self, sampler, media_paths: Callable, lookahead: int = 64, num_threads: int = 16):
+        self.sampler = sampler
+        self.media_paths = media_paths
+        self.prefetcher = MediaPrefetcher(num_threads)
+        self.lookahead = lookahead
+        self.pending = 0
+
+    def _prefetch(self, item) -> None:
+        indices = item if isinstance(item, (list, tuple)) else [item]
+        for idx in indices:
+            self.prefetcher.prefetch(self.media_paths, idx)
+
+    def __iter__(self):
+        window = deque()
+        for item in self.sampler:
+            window.append(item)
+            self._prefetch(item)
+            if len(window) > self.lookahead:
+                item = window.popleft()
+                self.pending = len(window)
+                yield item
+        while window:
+            item = window.popleft()
+            self.pending = len(window)
+            yield item
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def set_epoch(self, epoch: int) -> None:
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
@@ -0,0 +1,179 @@
+import os
+import json
+import mmap
+import tarfile
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .fetch import append_line
+
+ARCHIVE_INDEX = "index.json"
+
+
+def _key(path: str) -> str:
+    return os.path.normpath(path)
+
+
+def _source_files(paths: Iterable[str]) -> Iterable[str]:
+    """Expands directories (e.g. frame directories) into their files."""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def pack_media_archive(
+    paths: Iterable[str],
+    output_dir: str,
+    shard_bytes: int = 4 << 30,
+) -> None:
+    """Packs media files into uncompressed tar shards (`media_XXXXX.tar`)
+    plus an `index.json` mapping every file to (shard, offset, size) and
+    every directory to its sorted file names. `paths` are files or frame
+    directories as the dataset builds them (data_path joined with the
+    annotation entry); see LazySupervisedDataset.archive_paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shard_names: List[str] = []
+    # keys in member order; tar strips leading "/" from member names
+    shard_keys: List[List[str]] = []
+    tar = None
+    seen = set()
+    for path in _source_files(paths):
+        key = _key(path)
+        if key in seen:
+            continue
+        seen.add(key)
+        if tar is None or tar.offset >= shard_bytes:
+            if tar is not None:
+                tar.close()
+            shard_names.append(f"media_{len(shard_names):05d}.tar")
+            shard_keys.append([])
+            tar = tarfile.open(os.path.join(output_dir, shard_names[-1]), "w", format=tarfile.GNU_FORMAT)
+        tar.add(path, arcname=key, recursive=False)
+        shard_keys[-1].append(key)
+    if tar is not None:
+        tar.close()
+
+    # offsets of the member data are only known once the headers are written
+    files: Dict[str, List[int]] = {}
+    dirs: Dict[str, List[str]] = {}
+    for shard_id, shard_name in enumerate(shard_names):
+        with tarfile.open(os.path.join(output_dir, shard_name), "r") as tar:
+            for key, member in zip(shard_keys[shard_id], tar.getmembers()):
+                files[key] = [shard_id, member.offset_data, member.size]
+                dirs.setdefault(os.path.dirname(key), []).append(os.path.basename(key))
+    for names in dirs.values():
+        names.sort()
+    with open(os.path.join(output_dir, ARCHIVE_INDEX), "w") as f:
+        json.dump({"shards": shard_names, "files": files, "dirs": dirs}, f)
+
+
+class MediaArchive:
+    """Serves files packed by `pack_media_archive` from one mmap per shard.
+    Lookups, directory listings and reads need no per-file open or stat.
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        with open(os.path.join(archive_dir, ARCHIVE_INDEX), "r") as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.files = index["files"]
+        self.dirs = index["dirs"]
+        self._maps: Dict[int, mmap.mmap] = {}
+
+    def __getstate__(self):
+        # mmaps are re-opened lazily in each dataloader worker
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def __contains__(self, path: str) -> bool:
+        return _key(path) in self.files
+
+    def isdir(self, path: str) -> bool:
+        return _key(path) in self.dirs
+
+    def listdir(self, path: str) -> Optional[List[str]]:
+        """Sorted file names of a packed directory, or None."""
+        return self.dirs.get(_key(path))
+
+    def read(self, path: str) -> memoryview:
+        shard_id, offset, size = self.files[_key(path)]
+        if shard_id not in self._maps:
+            with open(os.path.join(self.archive_dir, self.shards[shard_id]), "rb") as f:
+                self._maps[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._maps[shard_id])[offset:offset + size]
+
+    def frame(self, video_dir: str, frame_idx: int) -> memoryview:
+        """Frame `frame_idx` (in sorted order) of a packed frame directory."""
+        return self.read(os.path.join(video_dir, self.dirs[_key(video_dir)][frame_idx]))
+
+
+class FrameManifestCache:
+    """Sorted file lists of frame directories, listed once and persisted as
+    an append-only jsonl (`{"dir": ..., "mtime": ..., "frames": [...]}` per
+    line) that all dataloader workers and ranks share. A stored listing is
+    checked against the directory's mtime the first time a process uses it
+    and trusted from then on, so later epochs and runs take listings from
+    memory; a directory whose mtime changed is listed again. Without a
+    `path` (or if it cannot be written) listings are only kept in memory.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.manifests: Dict[str, Tuple[int, List[str]]] = {}
+        self._checked: Set[str] = set()
+        if path is not None and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    # a partially written last line is simply listed again
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.manifests[entry["dir"]] = (entry.get("mtime"), entry["frames"])
+
+    def listdir(self, video_dir: str) -> List[str]:
+        key = _key(video_dir)
+        manifest = self.manifests.get(key)
+        if manifest is not None and key in self._checked:
+            return manifest[1]
+        mtime = os.stat(video_dir).st_mtime_ns
+        self._checked.add(key)
+        if manifest is not None and manifest[0] == mtime:
+            return manifest[1]
+        frames = sorted(
+            f for f in os.listdir(video_dir) if os.path.isfile(os.path.join(video_dir, f))
+        )
+        self.manifests[key] = (mtime, frames)
+        if self.path is not None:
+            line = json.dumps({"dir": key, "mtime": mtime, "frames": frames}) + "\n"
+            try:
+                append_line(self.path, line)
+            except OSError as e:
+                print(f"Could not store frame manifest in {self.path}: {e}")
+        return frames
+
+    def __contains__(self, video_dir: str) -> bool:
+        return _key(video_dir) in self.manifests
+
+    def __len__(self) -> int:
+        return len(self.manifests)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack media files or frame directories into tar shards.")
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--paths", type=str, required=True,
+                        help="text file with one media file or frame directory per line")
+    parser.add_argument("--shard_gb", type=float, default=4.0)
+    args = parser.parse_args()
+    with open(args.paths, "r") as f:
+        media_paths = [line.strip() for line in f if line.strip()]
+    pack_media_archive(media_paths, args.output_dir, int(args.shard_gb * (1 << 30)))
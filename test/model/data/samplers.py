@@ -0,0 +1,519 @@
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def token_budget_batches(
+    indices: Sequence[int],
+    lengths: np.ndarray,
+    max_tokens: int,
+    max_batch_size: Optional[int] = None,
+) -> List[List[int]]:
+    """Greedily splits `indices` (already ordered by length) into batches
+    whose padded size, batch size times longest sample, stays within
+    `max_tokens`. A sample longer than the budget gets a batch of its own.
+    """
+    batches, batch, longest = [], [], 0
+    for idx in indices:
+        length = int(lengths[idx])
+        new_longest = max(longest, length)
+        full = max_batch_size is not None and len(batch) >= max_batch_size
+        if batch and (full or new_longest * (len(batch) + 1) > max_tokens):
+            batches.append(batch)
+            batch, new_longest = [], length
+        batch.append(int(idx))
+        longest = new_longest
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pack_sequences(
+    indices: Sequence[int],
+    lengths: np.ndarray,
+    max_tokens: int,
+) -> List[List[int]]:
+    """First-fit-decreasing bin packing of `indices` into packs whose summed
+    length stays within `max_tokens`, for the flattened (packed) collator.
+    A sample longer than the budget gets a pack of its own.
+    """
+    order = sorted(indices, key=lambda idx: -int(lengths[idx]))
+    packs, free = [], []
+    for idx in order:
+        length = int(lengths[idx])
+        for j, space in enumerate(free):
+            if length <= space:
+                packs[j].append(int(idx))
+                free[j] -= length
+                break
+        else:
+            packs.append([int(idx)])
+            free.append(max_tokens - length)
+    return packs
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Batch sampler that groups samples of similar length (from the length
+    index of LazySupervisedDataset, visual tokens included) into batches of
+    at most `max_tokens` padded tokens. Samples are shuffled, sorted by length
+    within buckets of `bucket_size`, packed, and the batches shuffled again,
+    so padding stays low without ordering the whole epoch by length. Batches
+    are split across `num_replicas` ranks, each rank getting the same count.
+    If `tags` are given, a batch only holds samples of one tag, as required
+    by the collators when `images_vggt` is present, and all ranks get a
+    batch of the same tag at each step (see TagBatchSampler).
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        max_batch_size: Optional[int] = None,
+        bucket_size: int = 1024,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        tags: Optional[Sequence[str]] = None,
+    ):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.tags = None if tags is None else np.asarray(tags)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def _pack(self, bucket: np.ndarray) -> List[List[int]]:
+        bucket = bucket[np.argsort(-self.lengths[bucket], kind="stable")]
+        return token_budget_batches(
+            bucket, self.lengths, self.max_tokens, self.max_batch_size
+        )
+
+    def _build_batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        n = len(self.lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        if self.tags is None:
+            groups = [order]
+        else:
+            groups = [order[self.tags[order] == tag] for tag in np.unique(self.tags)]
+        steps = []
+        for group in groups:
+            batches = []
+            for start in range(0, len(group), self.bucket_size):
+                batches += self._pack(group[start:start + self.bucket_size])
+            if self.shuffle:
+                batches = [batches[j] for j in rng.permutation(len(batches))]
+            # a step holds one batch per rank, all of one tag; each tag's
+            # tail is dropped so that every rank runs the same steps
+            steps += [
+                batches[j:j + self.num_replicas]
+                for j in range(0, len(batches) - self.num_replicas + 1, self.num_replicas)
+            ]
+        if self.shuffle:
+            steps = [steps[j] for j in rng.permutation(len(steps))]
+        return [step[self.rank] for step in steps]
+
+    @property
+    def batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return self._batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+    def padding_ratio(self) -> float:
+        """Fraction of padded tokens in this rank's batches."""
+        real = sum(int(self.lengths[b].sum()) for b in self.batches)
+        padded = sum(int(self.lengths[b].max()) * len(b) for b in self.batches)
+        return 1 - real / max(padded, 1)
+
+
+class PackedBatchSampler(TokenBudgetBatchSampler):
+    """Yields packs for FlattenedDataCollatorForSupervisedDataset: samples
+    are bin-packed so that their summed length, rather than the padded size,
+    fills `max_tokens`. Packs are tag-homogeneous when `tags` are given.
+    """
+
+    def _pack(self, bucket: np.ndarray) -> List[List[int]]:
+        packs = pack_sequences(bucket, self.lengths, self.max_tokens)
+        if self.max_batch_size is None:
+            return packs
+        return [
+            pack[start:start + self.max_batch_size]
+            for pack in packs
+            for start in range(0, len(pack), self.max_batch_size)
+        ]
+
+    def utilization(self) -> float:
+        """Mean fraction of `max_tokens` filled by this rank's packs."""
+        used = sum(int(self.lengths[b].sum()) for b in self.batches)
+        return used / max(len(self.batches) * self.max_tokens, 1)
+
+
+def _mix64(x: np.ndarray) -> np.ndarray:
+    """splitmix64 finaliser, applied elementwise to uint64 arrays."""
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class FeistelPermutation:
+    """Pseudo-random permutation of range(n) keyed by (seed, epoch), evaluated
+    pointwise in O(1) memory: a balanced Feistel network over the smallest
+    even power of two >= n, with cycle-walking back into range(n).
+    """
+
+    def __init__(self, n: int, seed: int, epoch: int, rounds: int = 4):
+        self.n = n
+        bits = max(2, int(n - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = np.uint64(bits // 2)
+        self.half_mask = np.uint64((1 << (bits // 2)) - 1)
+        base = _mix64(np.array([seed * 1000003 + epoch], dtype=np.uint64))[0]
+        self.keys = [
+            _mix64(np.array([base + np.uint64(r)], dtype=np.uint64))[0]
+            for r in range(rounds)
+        ]
+
+    def _round_trip(self, x: np.ndarray) -> np.ndarray:
+        left, right = x >> self.half_bits, x & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix64(right ^ key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __call__(self, positions: np.ndarray) -> np.ndarray:
+        x = np.asarray(positions, dtype=np.uint64)
+        out = self._round_trip(x)
+        walking = out >= np.uint64(self.n)
+        while walking.any():
+            out[walking] = self._round_trip(out[walking])
+            walking = out >= np.uint64(self.n)
+        return out.astype(np.int64)
+
+
+class DeterministicDistributedSampler(Sampler):
+    """Distributed sampler whose order depends only on (seed, epoch). The
+    permutation is never materialised, so memory does not grow with the
+    dataset. `state_dict()` records how many samples (summed over ranks) of
+    the epoch were consumed; after `load_state_dict()` iteration resumes at
+    the next unconsumed sample, also with a different number of ranks.
+
+    The count advances as indices are yielded; since dataloader workers
+    prefetch, pass the number of samples actually trained on to
+    `state_dict(consumed_samples=...)` when it is known.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        chunk_size: int = 4096,
+    ):
+        if num_replicas is None or rank is None:
+            import torch.distributed as dist
+            initialized = dist.is_available() and dist.is_initialized()
+            if num_replicas is None:
+                num_replicas = dist.get_world_size() if initialized else 1
+            if rank is None:
+                rank = dist.get_rank() if initialized else 0
+        self.num_samples_total = dataset if isinstance(dataset, int) else len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.chunk_size = chunk_size
+        self.epoch = 0
+        self.consumed_samples = 0
+        n = self.num_samples_total
+        if drop_last:
+            self.total_size = n // num_replicas * num_replicas
+        else:
+            # wrap around so that every rank gets the same number of samples
+            self.total_size = -(-n // num_replicas) * num_replicas
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed_samples = 0
+
+    def __len__(self) -> int:
+        return max(self.total_size - self.consumed_samples, 0) // self.num_replicas
+
+    def __iter__(self) -> Iterator[int]:
+        n = self.num_samples_total
+        permutation = FeistelPermutation(n, self.seed, self.epoch) if self.shuffle else None
+        start = self.consumed_samples - self.consumed_samples % self.num_replicas
+        for chunk_start in range(start, self.total_size, self.chunk_size * self.num_replicas):
+            chunk_end = min(chunk_start + self.chunk_size * self.num_replicas, self.total_size)
+            positions = np.arange(chunk_start + self.rank, chunk_end, self.num_replicas) % n
+            indices = permutation(positions) if permutation is not None else positions
+            for idx in indices.tolist():
+                self.consumed_samples += self.num_replicas
+                yield idx
+
+    def state_dict(self, consumed_samples: Optional[int] = None) -> Dict:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "consumed_samples": self.consumed_samples if consumed_samples is None else consumed_samples,
+        }
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        if state_dict["seed"] != self.seed:
+            raise ValueError(
+                f"sampler seed {self.seed} does not match the checkpoint seed {state_dict['seed']}"
+            )
+        self.epoch = state_dict["epoch"]
+        self.consumed_samples = state_dict["consumed_samples"]
+
+
+class MixtureSampler(Sampler):
+    """Streams a weighted mixture of datasets without materialising it.
+    `groups` maps each dataset name to the indices of its samples (see
+    LazySupervisedDataset.dataset_groups). Dataset d is drawn with
+    probability proportional to (w_d * size_d) ** (1 / temperature), where
+    w_d is its entry in `weights` (default 1.0), so without weights datasets
+    mix in proportion to their size. Each dataset is read in its own (seed,
+    dataset epoch) permutation and restarts with a new one when exhausted;
+    `dataset_epochs` counts these restarts.
+
+    Draws are a deterministic function of the global stream position, which
+    is strided across ranks. The position and cursors advance step by step
+    as indices are yielded, so `state_dict()` / `load_state_dict()` resume
+    at the next step, also with a different number of ranks. Since
+    dataloader workers prefetch, a state saved during training is ahead of
+    the trained samples by the prefetched ones.
+    """
+
+    def __init__(
+        self,
+        groups: Dict[str, np.ndarray],
+        weights: Optional[Dict[str, float]] = None,
+        temperature: float = 1.0,
+        num_samples: Optional[int] = None,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+        chunk_size: int = 4096,
+    ):
+        self.names = [name for name, members in groups.items() if len(members)]
+        self.members = [np.asarray(groups[name], dtype=np.int64) for name in self.names]
+        self.sizes = np.array([len(m) for m in self.members], dtype=np.int64)
+        weights = weights or {}
+        base = np.array(
+            [weights.get(name, 1.0) * size for name, size in zip(self.names, self.sizes)],
+            dtype=np.float64,
+        )
+        probs = base ** (1.0 / temperature)
+        self.probs = probs / probs.sum()
+        self.cdf = np.cumsum(self.probs)
+        self.cdf[-1] = 1.0
+        self.num_samples = int(self.sizes.sum()) if num_samples is None else num_samples
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.chunk_size = chunk_size
+        self.epoch = 0
+        self.position = 0
+        # samples of each dataset drawn so far, over all mixture epochs
+        self.cursors = np.zeros(len(self.names), dtype=np.int64)
+
+    @property
+    def dataset_epochs(self) -> Dict[str, int]:
+        return {name: int(c // n) for name, c, n in zip(self.names, self.cursors, self.sizes)}
+
+    def set_epoch(self, epoch: int) -> None:
+        # a new mixture epoch redraws the dataset choices; datasets keep
+        # streaming from where they stopped
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+
+    def __len__(self) -> int:
+        remaining = max(self.num_samples - self.position, 0)
+        return len(range(self.rank, remaining, self.num_replicas))
+
+    def _choices(self, positions: np.ndarray) -> np.ndarray:
+        key = _mix64(np.array([self.seed * 1000003 + self.epoch], dtype=np.uint64))[0]
+        # top 53 bits of the hash as a uniform double in [0, 1)
+        bits = _mix64(positions.astype(np.uint64) ^ key) >> np.uint64(11)
+        u = bits.astype(np.float64) / float(1 << 53)
+        return np.searchsorted(self.cdf, u, side="right")
+
+    def _draw(self, dataset_idx: int, draws: np.ndarray) -> np.ndarray:
+        """Sample indices for the `draws`-th samples taken from a dataset."""
+        n = self.sizes[dataset_idx]
+        out = np.empty(len(draws), dtype=np.int64)
+        dataset_epochs = draws // n
+        for dataset_epoch in np.unique(dataset_epochs):
+            mask = dataset_epochs == dataset_epoch
+            permutation = FeistelPermutation(
+                int(n), self.seed * 1009 + dataset_idx, int(dataset_epoch)
+            )
+            out[mask] = self.members[dataset_idx][permutation(draws[mask] % n)]
+        return out
+
+    def __iter__(self) -> Iterator[int]:
+        while self.position < self.num_samples:
+            end = min(self.position + self.chunk_size * self.num_replicas, self.num_samples)
+            positions = np.arange(self.position, end)
+            choices = self._choices(positions)
+            indices = np.empty(len(positions), dtype=np.int64)
+            for dataset_idx in np.unique(choices):
+                mask = choices == dataset_idx
+                draws = self.cursors[dataset_idx] + np.arange(mask.sum())
+                indices[mask] = self._draw(dataset_idx, draws)
+            mine = np.nonzero((positions - self.rank) % self.num_replicas == 0)[0]
+            start = self.position
+            committed = 0
+            for j in mine.tolist():
+                # the step of position j is consumed on every rank
+                step_end = min((j // self.num_replicas + 1) * self.num_replicas, len(positions))
+                self.cursors += np.bincount(
+                    choices[committed:step_end], minlength=len(self.names)
+                )
+                self.position = start + step_end
+                committed = step_end
+                yield int(indices[j])
+            self.cursors += np.bincount(choices[committed:], minlength=len(self.names))
+            self.position = end
+
+    def state_dict(self) -> Dict:
+        return {
+            "seed": self.seed,
+            "epoch": self.epoch,
+            "position": self.position,
+            "cursors": dict(zip(self.names, self.cursors.tolist())),
+        }
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+        self.cursors = np.array(
+            [state_dict["cursors"].get(name, 0) for name in self.names], dtype=np.int64
+        )
+
+
+class TagBatchSampler(Sampler):
+    """Fixed-size batch sampler whose batches hold a single `tag` ("2d" or
+    "3d"), as the collators require when `images_vggt` is present. Within a
+    tag, samples are sorted by length inside buckets of `bucket_size`
+    batches to reduce padding. Tags are interleaved in proportion to
+    `ratios` (batches per tag, default 1 each) by smooth weighted
+    round-robin; once a tag runs out the others continue.
+
+    As in TokenBudgetBatchSampler, every step hands out `num_replicas`
+    batches of one tag, one per rank, so ranks never run different model
+    paths in the same step.
+    """
+
+    def __init__(
+        self,
+        tags: Sequence[str],
+        batch_size: int,
+        lengths: Optional[Sequence[int]] = None,
+        ratios: Optional[Dict[str, float]] = None,
+        bucket_size: int = 64,
+        drop_last: bool = True,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        self.tags = np.asarray(tags)
+        self.batch_size = batch_size
+        self.lengths = None if lengths is None else np.asarray(lengths, dtype=np.int64)
+        self.tag_names = sorted(np.unique(self.tags).tolist())
+        ratios = ratios or {}
+        self.ratios = {tag: float(ratios.get(tag, 1.0)) for tag in self.tag_names}
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def _tag_steps(self, members: np.ndarray, rng: np.random.Generator) -> List[List[List[int]]]:
+        members = members[rng.permutation(len(members))]
+        batches = []
+        bucket = self.bucket_size * self.batch_size
+        for start in range(0, len(members), bucket):
+            chunk = members[start:start + bucket]
+            if self.lengths is not None:
+                chunk = chunk[np.argsort(-self.lengths[chunk], kind="stable")]
+            batches += [
+                chunk[j:j + self.batch_size].tolist()
+                for j in range(0, len(chunk), self.batch_size)
+            ]
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        batches = [batches[j] for j in rng.permutation(len(batches))]
+        # a step needs one batch per rank
+        return [
+            batches[j:j + self.num_replicas]
+            for j in range(0, len(batches) - self.num_replicas + 1, self.num_replicas)
+        ]
+
+    def _build_batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        steps = {
+            tag: self._tag_steps(np.nonzero(self.tags == tag)[0], rng)
+            for tag in self.tag_names
+        }
+        cursors = {tag: 0 for tag in self.tag_names}
+        credit = {tag: 0.0 for tag in self.tag_names}
+        batches = []
+        while True:
+            active = [
+                tag for tag in self.tag_names
+                if cursors[tag] < len(steps[tag]) and self.ratios[tag] > 0
+            ]
+            if not active:
+                break
+            total = sum(self.ratios[tag] for tag in active)
+            for tag in active:
+                credit[tag] += self.ratios[tag]
+            tag = max(active, key=lambda t: credit[t])
+            credit[tag] -= total
+            batches.append(steps[tag][cursors[tag]][self.rank])
+            cursors[tag] += 1
+        return batches
+
+    @property
+    def batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self._build_batches()
+        return self._batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self.batches)
+
+    def __len__(self) -> int:
+        return len(self.batches)
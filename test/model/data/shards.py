@@ -0,0 +1,235 @@
+import os
+import json
+import mmap
+import bisect
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+SHARD_ALIGNMENT = 64
+
+# stored dtype of every field a compiled sample may contain
+FIELD_DTYPES = {
+    "input_ids": torch.int32,
+    "labels": torch.int32,
+    "position_ids": torch.int32,
+    "pixel_values": torch.bfloat16,
+    "image_grid_thw": torch.int32,
+    "images_vggt": torch.bfloat16,
+    "pixel_values_videos": torch.bfloat16,
+    "video_grid_thw": torch.int32,
+}
+# fields that are lists of per-image / per-video tensors in LazySupervisedDataset
+LIST_FIELDS = ["pixel_values", "image_grid_thw", "images_vggt", "pixel_values_videos", "video_grid_thw"]
+# fields returned as int64, as produced by preprocess_qwen_2_visual / get_rope_index
+LONG_FIELDS = ["input_ids", "labels", "position_ids", "image_grid_thw", "video_grid_thw"]
+
+_DTYPE_NAMES = {v: str(v).replace("torch.", "") for v in FIELD_DTYPES.values()}
+_NAME_DTYPES = {v: k for k, v in _DTYPE_NAMES.items()}
+
+
+def _shard_paths(output_dir, prefix, shard_id):
+    return (
+        os.path.join(output_dir, f"{prefix}_{shard_id:05d}.bin"),
+        os.path.join(output_dir, f"{prefix}_{shard_id:05d}.json"),
+    )
+
+
+class ShardWriter:
+    """Appends compiled samples to `<prefix>_XXXXX.bin` files, each paired
+    with a json index holding, per sample, the byte offset, dtype and shape
+    of every field. Tensors are 64-byte aligned so they can be mapped without
+    copies. The prefix must start with "shard_" for ShardedSupervisedDataset
+    to find the files.
+    """
+
+    def __init__(self, output_dir: str, samples_per_shard: int = 4096, prefix: str = "shard"):
+        self.output_dir = output_dir
+        self.samples_per_shard = samples_per_shard
+        self.prefix = prefix
+        self.shard_id = 0
+        os.makedirs(output_dir, exist_ok=True)
+        self._file = None
+        self._index: List[Dict] = []
+
+    def _open(self):
+        bin_path, _ = _shard_paths(self.output_dir, self.prefix, self.shard_id)
+        self._file = open(bin_path, "wb")
+        self._index = []
+
+    def _write_tensor(self, tensor: torch.Tensor, dtype: torch.dtype) -> Dict:
+        tensor = tensor.detach().to(dtype).contiguous().cpu()
+        pad = -self._file.tell() % SHARD_ALIGNMENT
+        self._file.write(b"\0" * pad)
+        offset = self._file.tell()
+        # numpy has no bfloat16, so write its raw 16-bit pattern
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        self._file.write(tensor.numpy().tobytes())
+        return {"offset": offset, "dtype": _DTYPE_NAMES[dtype], "shape": list(tensor.shape)}
+
+    def write(self, sample: Dict) -> None:
+        if self._file is None:
+            self._open()
+        entry = {"tag": sample.get("tag", "2d")}
+        for key, dtype in FIELD_DTYPES.items():
+            if key not in sample:
+                continue
+            value = sample[key]
+            if key in LIST_FIELDS:
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                entry[key] = [self._write_tensor(v, dtype) for v in value]
+            else:
+                entry[key] = self._write_tensor(value, dtype)
+        self._index.append(entry)
+        if len(self._index) >= self.samples_per_shard:
+            self.close()
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        self._file.close()
+        _, index_path = _shard_paths(self.output_dir, self.prefix, self.shard_id)
+        with open(index_path, "w") as f:
+            json.dump(self._index, f)
+        self._file = None
+        self.shard_id += 1
+
+
+def compile_shards(
+    dataset: Dataset,
+    output_dir: str,
+    samples_per_shard: int = 4096,
+    rank: int = 0,
+    world_size: int = 1,
+) -> None:
+    """Runs the full preprocessing of `dataset` (typically a
+    LazySupervisedDataset: decode, resize, patchify, tokenize, rope index)
+    once and stores the results in memory-mappable shards. Ranks compile
+    disjoint, interleaved subsets into shards prefixed with their rank.
+
+    Samples are loaded with `dataset._get_item` when it exists, so a sample
+    that fails is skipped instead of being replaced by a substitute that
+    would then be stored twice.
+    """
+    writer = ShardWriter(output_dir, samples_per_shard, prefix=f"shard_{rank:05d}")
+    get_item = getattr(dataset, "_get_item", dataset.__getitem__)
+    skipped = 0
+    for i in range(rank, len(dataset), world_size):
+        try:
+            sample = get_item(i)
+        except Exception as e:
+            print(f"Skipping sample {i}, failed to compile. Exception:", e)
+            skipped += 1
+            continue
+        writer.write(sample)
+    writer.close()
+    if skipped:
+        print(f"Rank {rank} skipped {skipped} samples")
+
+
+class ShardedSupervisedDataset(Dataset):
+    """Reads samples compiled by `compile_shards`. Shards are mapped with
+    copy-on-write mmap and tensors are created with `torch.frombuffer`, so
+    pixel data is served straight from the page cache. Samples have the same
+    layout as LazySupervisedDataset items; patches stay in bfloat16.
+    """
+
+    def __init__(self, shard_dir: str):
+        super(ShardedSupervisedDataset, self).__init__()
+        self.shard_dir = shard_dir
+        index_files = sorted(f for f in os.listdir(shard_dir) if f.startswith("shard_") and f.endswith(".json"))
+        self.shard_bins = []
+        self.shard_index = []
+        self.cumulative_sizes = []
+        total = 0
+        for index_file in index_files:
+            with open(os.path.join(shard_dir, index_file), "r") as f:
+                entries = json.load(f)
+            self.shard_bins.append(os.path.join(shard_dir, index_file[: -len(".json")] + ".bin"))
+            self.shard_index.append(entries)
+            total += len(entries)
+            self.cumulative_sizes.append(total)
+        self._maps: Dict[int, mmap.mmap] = {}
+        print(f"Total compiled samples: {total} in {len(index_files)} shards")
+
+    def __len__(self):
+        return self.cumulative_sizes[-1] if self.cumulative_sizes else 0
+
+    def __getstate__(self):
+        # mmaps are re-opened lazily in each dataloader worker
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+    def _map(self, shard_id: int) -> mmap.mmap:
+        if shard_id not in self._maps:
+            with open(self.shard_bins[shard_id], "rb") as f:
+                self._maps[shard_id] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return self._maps[shard_id]
+
+    def _tensor(self, buffer: mmap.mmap, meta: Dict, key: str) -> torch.Tensor:
+        dtype = _NAME_DTYPES[meta["dtype"]]
+        count = 1
+        for dim in meta["shape"]:
+            count *= dim
+        if count == 0:
+            tensor = torch.empty(meta["shape"], dtype=dtype)
+        else:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count, offset=meta["offset"]).view(meta["shape"])
+        if key in LONG_FIELDS:
+            tensor = tensor.long()
+        return tensor
+
+    def sample_entry(self, i: int) -> Tuple[int, Dict]:
+        shard_id = bisect.bisect_right(self.cumulative_sizes, i)
+        start = self.cumulative_sizes[shard_id - 1] if shard_id > 0 else 0
+        return shard_id, self.shard_index[shard_id][i - start]
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        shard_id, entry = self.sample_entry(i)
+        buffer = self._map(shard_id)
+        data_dict = {}
+        for key, meta in entry.items():
+            if key == "tag":
+                continue
+            if key in LIST_FIELDS:
+                data_dict[key] = [self._tensor(buffer, m, key) for m in meta]
+            else:
+                data_dict[key] = self._tensor(buffer, meta, key)
+        data_dict["tag"] = entry["tag"]
+        return data_dict
+
+    @property
+    def lengths(self):
+        return [entry["input_ids"]["shape"][0] for entries in self.shard_index for entry in entries]
+
+    @property
+    def sample_tags(self) -> np.ndarray:
+        return np.array([entry["tag"] for entries in self.shard_index for entry in entries])
+
+    @property
+    def modality_lengths(self):
+        # 2d samples are marked with negative lengths, as in LazySupervisedDataset
+        lengths = np.array(self.lengths, dtype=np.int64)
+        return (lengths * np.where(self.sample_tags == "2d", -1, 1)).tolist()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from .data_qwen import add_data_args, dataset_from_args
+
+    parser = argparse.ArgumentParser(description="Compile the samples of --dataset_use into memory-mapped shards.")
+    parser.add_argument("shard_dir", type=str)
+    add_data_args(parser)
+    parser.add_argument("--samples_per_shard", type=int, default=4096)
+    parser.add_argument("--rank", type=int, default=0)
+    parser.add_argument("--world_size", type=int, default=1)
+    args = parser.parse_args()
+    compile_shards(
+        dataset_from_args(args), args.shard_dir, args.samples_per_shard, args.rank, args.world_size
+    )
@@ -0,0 +1,136 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+import json
+import argparse
+import numbers
+
+import tqdm
+
+import habitat
+from habitat import Env
+from habitat_extensions import measures
+from habitat_baselines.config.default import get_config as get_habitat_config
+from habitat.config.default_structured_configs import (
+    CollisionsMeasurementConfig,
+    FogOfWarConfig,
+    TopDownMapMeasurementConfig,
+)
+from habitat.utils.visualizations.utils import images_to_video, observations_to_image
+
+
+class EpisodeReplayer:
+    """Re-steps habitat with the action sequences logged by eval.py (the
+    `actions` field of result.json), without loading a model. Actuation is
+    noiseless, so a replay reproduces the original run and can render
+    videos or evaluate measures that were not enabled at evaluation time.
+    """
+
+    def __init__(self, config_path: str, split: str, save_video: bool = False):
+        self.config = get_habitat_config(config_path)
+        self.save_video = save_video
+        with habitat.config.read_write(self.config):
+            self.config.habitat.dataset.split = split
+            measures.add_agent_state_measure(self.config)
+            measurements = {"collisions": CollisionsMeasurementConfig()}
+            if save_video:
+                measurements["top_down_map"] = TopDownMapMeasurementConfig(
+                    map_padding=3,
+                    map_resolution=1024,
+                    draw_source=True,
+                    draw_border=True,
+                    draw_shortest_path=True,
+                    draw_view_points=True,
+                    draw_goal_positions=True,
+                    draw_goal_aabbs=True,
+                    fog_of_war=FogOfWarConfig(
+                        draw=True,
+                        visibility_dist=5.0,
+                        fov=90,
+                    ),
+                )
+            self.config.habitat.task.measurements.update(measurements)
+        self.env = Env(config=self.config)
+        self.episodes = {
+            (episode.scene_id.split('/')[-2], str(episode.episode_id)): episode
+            for episode in self.env.episodes
+        }
+
+    def replay(self, scene_id: str, episode_id: str, actions):
+        """Returns (metrics, frames); frames is empty unless save_video."""
+        self.env.current_episode = self.episodes[(scene_id, str(episode_id))]
+        observations = self.env.reset()
+        frames = []
+        for action in actions:
+            if self.env.episode_over:
+                break
+            if self.save_video:
+                info = self.env.get_metrics()
+                frames.append(observations_to_image({'rgb': observations['rgb']}, info))
+            observations = self.env.step(action)
+        return self.env.get_metrics(), frames
+
+    def close(self) -> None:
+        self.env.close()
+
+
+def select_results(results_path, only_failures=False, only_timeouts=False,
+                   max_steps=400, episode_ids=None):
+    selected = []
+    with open(results_path, 'r') as f:
+        for line in f.readlines():
+            res = json.loads(line)
+            if "actions" not in res:
+                # aggregate line or a run without action logging
+                continue
+            if only_failures and res['success'] > 0.001:
+                continue
+            if only_timeouts and res['steps'] < max_steps:
+                continue
+            if episode_ids and str(res['episode_id']) not in episode_ids:
+                continue
+            selected.append(res)
+    return sorted(selected, key=lambda r: (r['scene_id'], str(r['episode_id'])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--habitat_config_path", type=str, default='config/vln_r2r.yaml')
+    parser.add_argument("--eval_split", type=str, default='val_unseen')
+    parser.add_argument("--results", type=str, default='./results/val_unseen/result.json')
+    parser.add_argument("--output_path", type=str, default='./results/val_unseen/replay')
+    parser.add_argument("--save_video", action="store_true", default=False)
+    parser.add_argument("--only_failures", action="store_true", default=False)
+    parser.add_argument("--only_timeouts", action="store_true", default=False)
+    parser.add_argument('--max_steps', default=400, type=int, help='max_steps')
+    parser.add_argument("--episode_ids", type=str, nargs="*", default=None)
+    parser.add_argument('--world_size', default=1, type=int,
+                        help='number of replay processes')
+    parser.add_argument('--rank', default=0, type=int, help='rank')
+    args = parser.parse_args()
+
+    selected = select_results(
+        args.results, args.only_failures, args.only_timeouts,
+        args.max_steps, set(args.episode_ids or []),
+    )[args.rank::args.world_size]
+    os.makedirs(args.output_path, exist_ok=True)
+
+    replayer = EpisodeReplayer(args.habitat_config_path, args.eval_split, args.save_video)
+    for res in tqdm.tqdm(selected, desc="replay"):
+        scene_id, episode_id = res['scene_id'], res['episode_id']
+        metrics, frames = replayer.replay(scene_id, episode_id, res['actions'])
+        if frames:
+            images_to_video(
+                frames, os.path.join(args.output_path, 'vis'), f'{scene_id}_{episode_id}', fps=6, quality=9
+            )
+        result = {"scene_id": scene_id, "episode_id": episode_id}
+        result.update({k: float(v) for k, v in metrics.items() if isinstance(v, numbers.Number)})
+        # a mismatch means the run was not deterministic (e.g. a different config)
+        result["matches_eval"] = abs(metrics['success'] - res['success']) < 1e-6
+        with open(os.path.join(args.output_path, f'replay_result_{args.rank}.json'), 'a') as f:
+            f.write(json.dumps(result) + "\n")
+    replayer.close()
+
+
+if __name__ == "__main__":
+    main()